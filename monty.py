@@ -1,16 +1,45 @@
+import os
+import json
 import math
+import queue
+import types
+import pickle
 import random
+import hashlib
+import tempfile
+import importlib
+import threading
+import socketserver
 import itertools
+import heapq
+from fractions import Fraction
 from collections import Counter, defaultdict
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 REST = object()
 
-def join(*ds):
+def join(*ds, resolution=None, columnar=False):
     """
     Joins many (potientially nested) distributions into a single flat
     distribution containing all possible combinations, with associated
-    odds.
+    odds. For many mostly independent components, see `Joint`.
+
+    `resolution` defaults to the finest resolution of the given
+    distributions, see `Distribution.bucket`. The result is exact (see
+    `Distribution`) if all given distributions are. If `columnar` is true, the
+    result is a `Table`, which stores each component as a separate column
+    instead of building one tuple per combination. This is ignored if a
+    resolution is in effect, or if any distribution has repeated values
+    (`force_merge=False`), since those combinations must be merged.
     """
+    if resolution is None:
+        resolution = min((d.resolution for d in ds if getattr(d, 'resolution', None) is not None), default=None)
+    if columnar and ds and resolution is None and all(getattr(d, 'force_merge', True) for d in ds):
+        return Table.product(*ds)
     result = []
     for pairs in itertools.product(*ds):
         total_p = 1
@@ -19,7 +48,32 @@ def join(*ds):
             total_p *= p
             value.append(v)
         result.append((tuple(value), total_p))
-    return Distribution(*result)
+    return Distribution(*result, resolution=resolution, exact=bool(ds) and all(getattr(d, 'exact', False) for d in ds))
+
+def _snap(value, resolution):
+    """
+    Rounds a number (or the numbers in a tuple) to the nearest multiple of
+    `resolution`. Other values are returned unchanged.
+    """
+    if isinstance(value, tuple):
+        return tuple(_snap(v, resolution) for v in value)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        inverse = 1 / resolution
+        if not isinstance(resolution, int) and inverse == round(inverse):
+            # Dividing by an integer avoids noise like 3*0.1 = 0.30000000000000004.
+            return round(value * inverse) / inverse
+        return round(value / resolution) * resolution
+    else:
+        return value
+
+def _exact(odds):
+    """
+    Converts odds to an exact number. Floats are taken as the decimal number
+    they are displayed as, e.g. 0.1 becomes Fraction(1, 10).
+    """
+    if isinstance(odds, float):
+        return Fraction(repr(odds))
+    return odds + 0
 
 class Distribution:
     """
@@ -31,7 +85,7 @@ class Distribution:
             (0.01, 'Sideways'),
         )
     """
-    def __init__(self, *args, force_merge=True, force_flatten=True, **kwargs):
+    def __init__(self, *args, force_merge=True, force_flatten=True, resolution=None, exact=False, **kwargs):
         """
         Creates a new distribution from keyword arguments, a dictionary, a list
         of tuples `(value, odds)`, or just many tuples as arguments. If the
@@ -42,6 +96,13 @@ class Distribution:
         be hashable. Defaults to True.
         - `force_flatten`: if a value is another Distribution or subclass,
         incorporates its values into a flat object. Defaults to True.
+        - `resolution`: if given, numeric values (including numbers in tuples)
+        are rounded to multiples of it before merging, and distributions
+        derived from this one keep rounding to it. Defaults to None.
+        - `exact`: keeps odds as integers, scaling all of them by the least
+        common multiple of their denominators if needed, and normalizes to
+        `Fraction`s. Avoids floating point errors entirely, and is kept by
+        distributions derived from this one. Defaults to False.
 
         Examples:
 
@@ -53,6 +114,10 @@ class Distribution:
         """
         self.force_flatten = force_flatten
         self.force_merge = force_merge
+        self.resolution = resolution
+        self.exact = exact
+        self._normalized = None
+        self._hash = None
 
         if kwargs:
             # Distribution(a=0.5, b=0.1, c=REST)
@@ -81,17 +146,28 @@ class Distribution:
                     raise ValueError('REST probability can only be used when the total is < 1.')
                 odds = 1 - self.total
                 used_rest = True
+            elif exact:
+                odds = _exact(odds)
 
             if odds < 0:
                 raise ValueError('Odds cannot be negative.')
 
             if force_flatten and isinstance(value, Distribution):
-                pairs_list.extend((v, odds*o) for v, o in value.normalize())
+                pairs_list.extend((v, odds*o) for v, o in value._leaves())
             else:
                 pairs_list.append((value, odds))
 
             self.total += odds
 
+        if resolution is not None:
+            pairs_list = [(_snap(value, resolution), odds) for value, odds in pairs_list]
+
+        if exact:
+            pairs_list = [(value, _exact(odds)) for value, odds in pairs_list]
+            scale = math.lcm(*(odds.denominator for value, odds in pairs_list if isinstance(odds, Fraction)))
+            pairs_list = [(value, int(odds * scale)) for value, odds in pairs_list]
+            self.total = sum(odds for value, odds in pairs_list)
+
         if force_merge:
             counter = Counter()
             for value, odds in pairs_list:
@@ -101,6 +177,45 @@ class Distribution:
             # Using tuple makes it hashable as long as the values are hashable.
             self.pairs = tuple(pairs_list)
 
+    @classmethod
+    def _from_pairs(cls, pairs, total, force_flatten=True, force_merge=True, resolution=None, exact=False):
+        """
+        Creates a new distribution from a tuple of pairs that are already
+        validated, flattened and merged, skipping all the work done by
+        `__init__`. For internal use only.
+        """
+        self = object.__new__(cls)
+        self.force_flatten = force_flatten
+        self.force_merge = force_merge
+        self.resolution = resolution
+        self.exact = exact
+        self._normalized = None
+        self._hash = None
+        self.total = total
+        self.pairs = pairs
+        return self
+
+    def _leaves(self):
+        """
+        Generates the normalized pairs `(value, odds)` of this distribution,
+        with nested distributions expanded into their values, except inside
+        distributions created with `force_flatten=False`, whose nested
+        distributions are kept as values. The tree is walked once and
+        iteratively (so there's no recursion limit), multiplying the odds
+        along each path and reusing the cached normalized pairs of each
+        sub-distribution. Equal values are not merged.
+        """
+        stack = [(iter(self.normalize()), 1, self.force_flatten)]
+        while stack:
+            pairs, weight, flatten = stack[-1]
+            for value, odds in pairs:
+                if flatten and isinstance(value, Distribution):
+                    stack.append((iter(value.normalize()), weight * odds, value.force_flatten))
+                    break
+                yield value, weight * odds
+            else:
+                stack.pop()
+
     def __getitem__(self, target):
         for value, odds in self:
             if value == target:
@@ -110,11 +225,19 @@ class Distribution:
     def normalize(self):
         """
         Returns a new distribution with the probabilities normalized so that
-        their total sums to 1.
+        their total sums to 1. The result is computed once and cached.
         """
-        if math.isclose(self.total, 1) or self.total == 0:
+        if self.total == 0 or (self.total == 1 if self.exact else math.isclose(self.total, 1)):
             return self
-        return Distribution(*((v, p/self.total) for v, p in self), force_flatten=self.force_flatten, force_merge=self.force_merge)
+        if self._normalized is None:
+            # The pairs are already merged and flattened, so there's no need
+            # to go through the full constructor again.
+            if self.exact:
+                pairs = tuple((v, Fraction(p, self.total)) for v, p in self)
+            else:
+                pairs = tuple((v, p/self.total) for v, p in self)
+            self._normalized = Distribution._from_pairs(pairs, sum(p for v, p in pairs), force_flatten=self.force_flatten, force_merge=self.force_merge, resolution=self.resolution, exact=self.exact)
+        return self._normalized
 
     def generate(self, n=-1):
         """
@@ -142,13 +265,101 @@ class Distribution:
             yield next(value for value, r in cummulative_pairs if r >= choice)
             n -= 1
 
+    def generate_without_replacement(self, k, n=-1):
+        """
+        Generates infinite random draws of `k` values without replacement,
+        each as a tuple in draw order. Uses weighted reservoir sampling, so the
+        possible draws are never enumerated. If `n` is given, only `n` draws
+        are generated.
+        """
+        if n == 0:
+            return
+        # Efraimidis-Spirakis: the k largest keys u**(1/odds) are a weighted
+        # sample without replacement, in draw order. The keys are compared in
+        # log space, log(u)/odds, since u**(1/odds) underflows to 0 for small
+        # odds.
+        candidates = [(v, 1/p) for v, p in self if p > 0]
+        if k > len(candidates):
+            raise ValueError('Cannot draw {} values without replacement from distribution with {} possible values.'.format(k, len(candidates)))
+
+        while n != 0:
+            chosen = heapq.nlargest(k, candidates, key=lambda pair: -random.expovariate(1) * pair[1])
+            yield tuple(v for v, exponent in chosen)
+            n -= 1
+
+    def sample_without_replacement(self, k, ordered=True):
+        """
+        Returns the exact distribution of drawing `k` values without
+        replacement, each draw picking one of the remaining values with
+        probability proportional to its odds. Values are tuples in draw order
+        or, if `ordered` is False, in the order of this distribution (so that
+        the same hand drawn in different orders is merged).
+
+        This enumerates all possible draws, so for large distributions use
+        `generate_without_replacement` instead.
+        """
+        pairs = self.pairs
+        if k > len(pairs):
+            raise ValueError('Cannot draw {} values without replacement from distribution with {} values.'.format(k, len(pairs)))
+
+        if self.total > 0 and len(set(p for v, p in pairs)) <= 1:
+            # Equal odds: every draw (and every hand) is equally likely.
+            values = [v for v, p in pairs]
+            draws = itertools.permutations(values, k) if ordered else itertools.combinations(values, k)
+            return Uniform(list(draws), force_merge=self.force_merge, exact=self.exact)
+
+        result = []
+        for draw in itertools.permutations(range(len(pairs)), k):
+            remaining = self.total
+            odds = 1
+            for i in draw:
+                if not remaining:
+                    odds = 0
+                elif self.exact:
+                    odds = odds * Fraction(pairs[i][1], remaining)
+                else:
+                    odds = odds * pairs[i][1] / remaining
+                remaining -= pairs[i][1]
+            result.append((tuple(pairs[i][0] for i in (draw if ordered else sorted(draw))), odds))
+        return Distribution(*result, force_merge=self.force_merge, exact=self.exact)
+
+    def deal(self, k):
+        """
+        Returns the distribution of hands of `k` values drawn without
+        replacement, regardless of order. Shortcut for
+        `self.sample_without_replacement(k, ordered=False)`.
+        """
+        return self.sample_without_replacement(k, ordered=False)
+
+    def hypergeometric(self, k, fn=None, **kwargs):
+        """
+        Returns the distribution of how many of `k` values drawn without
+        replacement pass the test `fn`, which follows the same conventions as
+        `filter`. When all values have equal odds (e.g. a deck of cards) the
+        hypergeometric formula is used, without enumerating the possible hands.
+        """
+        fn = self._prepare_transformation(fn, kwargs)
+        if k > len(self):
+            raise ValueError('Cannot draw {} values without replacement from distribution with {} values.'.format(k, len(self)))
+
+        if len(set(p for v, p in self)) > 1:
+            return self.deal(k).map(lambda hand: sum(1 for v in hand if fn(v)))
+
+        population = len(self)
+        successes = sum(1 for v, p in self if fn(v))
+        hands = math.comb(population, k)
+        if self.exact:
+            # Counts of hands, which are integers already.
+            return Distribution(*((x, math.comb(successes, x) * math.comb(population - successes, k - x)) for x in range(max(0, k - population + successes), min(k, successes) + 1)), exact=True)
+        return Distribution(*((x, math.comb(successes, x) * math.comb(population - successes, k - x) / hands) for x in range(max(0, k - population + successes), min(k, successes) + 1)))
+
     def monte_carlo(self, fn, n=100000):
         """
         Given a distribution and a function to process lists of examples, returns
         the distribution of processed examples.
         """
         counter = Counter(fn(self.generate(n)))
-        return Distribution(*sorted(counter.items()), force_flatten=self.force_flatten)
+        return Distribution(*sorted(counter.items()), force_flatten=self.force_flatten, resolution=self.resolution, exact=self.exact)
 
     def __str__(self):
         """
@@ -157,56 +368,233 @@ class Distribution:
         """
         return self.as_plot(title=None, sort=False, filter=False)
 
-    def as_plot(self, title=None, sort=True, filter=True):
+    def as_plot(self, title=None, sort=True, filter=True, bins=None, top=None):
         """
         Returns this distribution as a string representation of a horizontal bar
         plot.
+
+        - `bins`: groups numeric values into this many equal-width buckets,
+        displayed in order.
+        - `top`: displays only the `top` most likely entries, followed by an
+        "Other" row with the remaining probability. Only the displayed values
+        are converted to strings.
         """
-        lines = []
+        return '\n'.join(self._plot_lines(title, sort, filter, bins, top))
 
+    def _plot_lines(self, title, sort, filter, bins, top):
+        """
+        Generates the lines of the plot returned by `as_plot`, one at a time.
+        """
         if title is not None:
-            lines.append(title)
-        lines.append('')
+            yield title
+        yield ''
+
+        for str_value, probability in self._plot_pairs(sort, filter, bins, top):
+            probability = float(probability)
+            bar = '['+(round(probability * 40) * '=').ljust(40)+']'
+            # 29 is used to make the whole line be 80 characters, ensuring
+            # every plot is aligned with every other plot.
+            yield '{:>29} {:>7.2%} {}'.format(str_value, probability, bar)
+        yield ''
+
+    def _plot_pairs(self, sort, filter, bins, top):
+        """
+        Returns the pairs `(label, probability)` displayed by `as_plot`.
+        """
+        pairs = self.normalize()
+
+        if bins is not None:
+            pairs = [(label, p) for label, p in self._bin(pairs, bins) if p != 0 or not filter]
+            return pairs if top is None else self._top(pairs, top, sort=False)
+
+        if top is not None:
+            return self._top((pair for pair in pairs if pair[1] != 0 or not filter), top, sort)
 
         if sort:
             counter = Counter()
-            for v, p in self.normalize():
+            for v, p in pairs:
                 if p != 0 or not filter:
                     counter[str(v)] += p
-            pairs = counter.most_common()
+            return counter.most_common()
         else:
-            pairs = ((str(v), p) for v, p in self.normalize() if filter or p != 0)
-
-        for str_value, probability in pairs:
-            bar = '['+(round(probability * 40) * '=').ljust(40)+']'
-            # 29 is used to make the whole line be 80 characters, ensuring
-            # every plot is aligned with every other plot.
-            lines.append('{:>29} {:>7.2%} {}'.format(str_value, probability, bar))
-        lines.append('')
-        return '\n'.join(lines)
+            return ((str(v), p) for v, p in pairs if filter or p != 0)
 
+    @staticmethod
+    def _bin(pairs, bins):
+        """
+        Groups numeric `pairs` into `bins` equal-width buckets between the
+        smallest and largest values, returning pairs `(label, probability)`.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return []
+        low = min(v for v, p in pairs)
+        high = max(v for v, p in pairs)
+        width = (high - low) / bins or 1
+        totals = [0] * bins
+        for v, p in pairs:
+            totals[min(int((v - low) / width), bins - 1)] += p
+        # The last bin also includes the largest value.
+        return [('[{:.4g}, {:.4g}{}'.format(low + i*width, low + (i+1)*width, ']' if i == bins - 1 else ')'), p) for i, p in enumerate(totals)]
 
-    def plot(self, title=None, sort=True, filter=True):
+    @staticmethod
+    def _top(pairs, n, sort):
+        """
+        Selects the `n` pairs with largest probability, converting only those
+        values to strings, and adds an "Other" row with the remaining
+        probability, if any.
         """
-        Prints a horizontal bar plot of values in the given distribution.
+        pairs = list(pairs)
+        indexes = heapq.nlargest(n, range(len(pairs)), key=lambda i: pairs[i][1])
+        if not sort:
+            indexes.sort()
+        selected = [(str(pairs[i][0]), pairs[i][1]) for i in indexes]
+        if len(pairs) > n:
+            chosen = set(indexes)
+            selected.append(('Other', sum(p for i, (v, p) in enumerate(pairs) if i not in chosen)))
+        return selected
+
+    def plot(self, title=None, sort=True, filter=True, bins=None, top=None, file=None):
         """
-        print(self.as_plot(title, sort, filter))
+        Prints a horizontal bar plot of values in the given distribution. The
+        plot is written to `file` (default: stdout) one line at a time,
+        without building the whole string.
+        """
+        for line in self._plot_lines(title, sort, filter, bins, top):
+            print(line, file=file)
         return self
 
+    def _sorted_pairs(self):
+        return sorted(self.pairs, key=lambda pair: pair[0])
+
+    def compare(self, other):
+        """
+        Compares a value from this distribution with an independent value from
+        `other`, returning the distribution of -1 (smaller), 0 (equal) and 1
+        (larger). Equivalent to
+        `join(self, other).map(lambda s: (s[0] > s[1]) - (s[0] < s[1]))`, but
+        sorts both distributions and sweeps them once, instead of comparing
+        every pair. Values must be totally ordered.
+        """
+        a = self._sorted_pairs()
+        b = other._sorted_pairs()
+        other_total = sum(p for v, p in b)
+        less = equal = greater = 0
+        j = 0
+        below = 0
+        for value, odds in a:
+            while j < len(b) and b[j][0] < value:
+                below += b[j][1]
+                j += 1
+            same = 0
+            k = j
+            while k < len(b) and b[k][0] == value:
+                same += b[k][1]
+                k += 1
+            less += odds * (other_total - below - same)
+            equal += odds * same
+            greater += odds * below
+        return Distribution._from_pairs(((-1, less), (0, equal), (1, greater)), less + equal + greater, exact=self.exact and other.exact)
+
+    def beats(self, other):
+        """
+        Returns the probability of a value from this distribution being larger
+        than an independent value from `other`. See `compare`.
+        """
+        comparison = self.compare(other).normalize()
+        return comparison[1]
+
+    def _sweep_extremes(self, other):
+        """
+        Sweeps the sorted values of both distributions, generating tuples
+        `(value, a, b, a_below, b_below)` with the odds of each distribution
+        at `value`, and their total odds strictly below `value`.
+        """
+        a = self._sorted_pairs()
+        b = other._sorted_pairs()
+        i = j = 0
+        a_below = b_below = 0
+        while i < len(a) or j < len(b):
+            if j == len(b) or (i < len(a) and a[i][0] < b[j][0]):
+                value = a[i][0]
+            else:
+                value = b[j][0]
+            a_odds = b_odds = 0
+            while i < len(a) and a[i][0] == value:
+                a_odds += a[i][1]
+                i += 1
+            while j < len(b) and b[j][0] == value:
+                b_odds += b[j][1]
+                j += 1
+            yield value, a_odds, b_odds, a_below, b_below
+            a_below += a_odds
+            b_below += b_odds
+
+    def maximum(self, other):
+        """
+        Returns the distribution of the largest of a value from this
+        distribution and an independent value from `other`. Equivalent to
+        `join(self, other).map(max)`, but computed with a single sweep over
+        the sorted values.
+        """
+        pairs = tuple((value, a * (b_below + b) + b * a_below) for value, a, b, a_below, b_below in self._sweep_extremes(other))
+        # Values that can never be the extreme are omitted, like in `join`.
+        pairs = tuple((v, p) for v, p in pairs if p)
+        return Distribution._from_pairs(pairs, sum(p for v, p in pairs), exact=self.exact and other.exact)
+
+    def minimum(self, other):
+        """
+        Returns the distribution of the smallest of a value from this
+        distribution and an independent value from `other`. Equivalent to
+        `join(self, other).map(min)`, but computed with a single sweep over
+        the sorted values.
+        """
+        a_total = sum(p for v, p in self)
+        b_total = sum(p for v, p in other)
+        pairs = tuple((value, a * (b_total - b_below) + b * (a_total - a_below - a)) for value, a, b, a_below, b_below in self._sweep_extremes(other))
+        # Values that can never be the extreme are omitted, like in `join`.
+        pairs = tuple((v, p) for v, p in pairs if p)
+        return Distribution._from_pairs(pairs, sum(p for v, p in pairs), exact=self.exact and other.exact)
+
     def __mul__(self, n):
         return join(*[self]*n)
     __rmul__ = __mul__
 
-    def transform(self, fn):
+    def unordered_power(self, n):
+        """
+        Like `n * distribution`, but ignoring the order of the draws. Values
+        are tuples of `n` values in the order of this distribution, with odds
+        multiplied by the number of orderings that produce them (multinomial
+        coefficient). For example 10 d6 rolls give 3003 outcomes instead of
+        60466176.
+        """
+        pairs = self.pairs
+        result = []
+        for indexes in itertools.combinations_with_replacement(range(len(pairs)), n):
+            orderings = math.factorial(n)
+            odds = 1
+            for i, group in itertools.groupby(indexes):
+                repetitions = len(list(group))
+                orderings //= math.factorial(repetitions)
+                odds *= pairs[i][1] ** repetitions
+            result.append((tuple(pairs[i][0] for i in indexes), orderings * odds))
+        return Distribution(*result, force_merge=self.force_merge, exact=self.exact)
+    combinations = unordered_power
+
+    def transform(self, fn, resolution=None):
         """
         Replaces every value with a sub-distribution given by `fn(value)`.
         `fn` may return a Distribution (or Uniform) instance, or simply a
         list of (value, odds) pairs. Returns the flattened
-        aggregated distribution.
+        aggregated distribution, rounded to `resolution` (defaults to this
+        distribution's resolution).
         """
-        return Distribution(*(fn(*pair) for pair in self), force_flatten=self.force_flatten, force_merge=self.force_merge)
+        if resolution is None:
+            resolution = self.resolution
+        return Distribution(*(fn(*pair) for pair in self), force_flatten=self.force_flatten, force_merge=self.force_merge, resolution=resolution, exact=self.exact)
 
-    def _prepare_transformation(self, fn, kwargs):
+    @staticmethod
+    def _prepare_transformation(fn, kwargs):
         if kwargs:
             assert fn is None
             return kwargs.__getitem__
@@ -229,6 +617,8 @@ class Distribution:
         so that only items in the list will be selected.
         """
         fn = self._prepare_transformation(fn, kwargs)
+        if self.exact:
+            return self.transform(lambda v, p: (v, p*_exact(fn(v))))
         return self.transform(lambda v, p: (v, p*fn(v)))
     update = filter
 
@@ -239,15 +629,16 @@ class Distribution:
         """
         return self.filter(lambda e: fn(*e))
 
-    def map(self, fn=None, **kwargs):
+    def map(self, fn=None, resolution=None, **kwargs):
         """
         Applies a function to each value in this distribution, then returns the
-        distribution of the aggregated results.
+        distribution of the aggregated results. Numeric results are rounded to
+        `resolution`, if given (see `bucket`).
 
         `fn` can also be a dictionary, mapping values to their replacements.
         """
         fn = self._prepare_transformation(fn, kwargs)
-        return self.transform(lambda v, p: (fn(v), p))
+        return self.transform(lambda v, p: (fn(v), p), resolution)
     group = group_by = map
 
     def sum(self):
@@ -256,12 +647,183 @@ class Distribution:
         """
         return self.map(sum)
 
-    def starmap(self, fn):
+    def starmap(self, fn, resolution=None):
         """
         Behaves like `distribution.map`, but the given function `fn` is called
         as `fn(*e)` instead of `fn(e)`.
         """
-        return self.transform(lambda v, p: (fn(*v), p))
+        return self.transform(lambda v, p: (fn(*v), p), resolution)
+
+    def _columns(self):
+        """
+        Returns the values as a list of NumPy arrays, one per tuple element (or
+        a single one, for non-tuple values). Returns None if NumPy is not
+        installed or the values are not all numbers or tuples of numbers of
+        the same length.
+        """
+        if numpy is None or not self.pairs:
+            return None
+        try:
+            array = numpy.array([v for v, p in self])
+        except ValueError:
+            return None
+        if array.dtype.kind not in 'biuf' or array.ndim > 2:
+            return None
+        return list(array.T) if array.ndim == 2 else [array]
+
+    def map_array(self, fn):
+        """
+        Vectorized version of `map` for numeric values. `fn` is called only
+        once, with all values as a NumPy array (or one array per element, for
+        tuple values), and must return an array of results (or a tuple of
+        arrays, for tuple results). Scalar results are broadcast to all
+        values. Equal results are merged with NumPy too, unless `force_merge`
+        is false. Example:
+
+            d.map_array(lambda x: x % 7)
+            join(d6, d6).map_array(lambda a, b: a > b)
+
+        If NumPy is not installed, or values are not numeric, falls back to
+        calling `fn` once per value (with `*value`, for tuples).
+        """
+        columns = self._columns()
+        if columns is None:
+            return self.starmap(fn) if self.pairs and isinstance(self.pairs[0][0], tuple) else self.map(fn)
+
+        results = fn(*columns)
+        odds_list = [p for v, p in self]
+        odds = numpy.array(odds_list, dtype=float)
+        if isinstance(results, tuple):
+            results = numpy.column_stack([numpy.broadcast_to(r, odds.shape) for r in results])
+        else:
+            results = numpy.asarray(results)
+            if results.ndim == 0:
+                results = numpy.broadcast_to(results, odds.shape)
+        if len(results) != len(odds):
+            raise ValueError('Expected {} results from map_array function, got {}.'.format(len(odds), len(results)))
+
+        if not self.force_merge:
+            values = [tuple(v) for v in results.tolist()] if results.ndim == 2 else results.tolist()
+            pairs = tuple(zip(values, odds_list if self.exact else odds.tolist()))
+            return Distribution(*pairs, force_merge=False, resolution=self.resolution, exact=self.exact)
+
+        # Keep the order of first occurrence, like `map`.
+        unique, first_indexes, inverse = numpy.unique(results, axis=0, return_index=True, return_inverse=True)
+        order = numpy.argsort(first_indexes)
+        values = unique[order].tolist()
+        if unique.ndim == 2:
+            values = [tuple(v) for v in values]
+        if self.exact:
+            # Sum the exact odds in Python, NumPy would convert them to floats.
+            sums = [0] * len(unique)
+            for i, p in zip(inverse.ravel().tolist(), odds_list):
+                sums[i] += p
+            pairs = tuple(zip(values, (sums[i] for i in order.tolist())))
+        else:
+            sums = numpy.bincount(inverse.ravel(), weights=odds, minlength=len(unique))
+            pairs = tuple(zip(values, sums[order].tolist()))
+        if self.resolution is not None or self.exact:
+            return Distribution(*pairs, force_merge=self.force_merge, resolution=self.resolution, exact=self.exact)
+        return Distribution._from_pairs(pairs, sum(p for v, p in pairs), force_flatten=self.force_flatten, force_merge=self.force_merge)
+
+    def filter_array(self, fn):
+        """
+        Vectorized version of `filter` for numeric values. `fn` is called only
+        once, with all values as a NumPy array (or one array per element, for
+        tuple values), and must return an array of odds multipliers (or
+        booleans). Example:
+
+            join(d6, d6).filter_array(lambda a, b: a != b)
+
+        If NumPy is not installed, or values are not numeric, falls back to
+        calling `fn` once per value (with `*value`, for tuples).
+        """
+        columns = self._columns()
+        if columns is None:
+            return self.starfilter(fn) if self.pairs and isinstance(self.pairs[0][0], tuple) else self.filter(fn)
+
+        if self.exact:
+            multipliers = numpy.broadcast_to(fn(*columns), (len(self.pairs), )).tolist()
+            return Distribution(*((v, p * _exact(m)) for (v, p), m in zip(self, multipliers)), force_flatten=self.force_flatten, force_merge=self.force_merge, resolution=self.resolution, exact=True)
+        odds = numpy.array([p for v, p in self], dtype=float) * fn(*columns)
+        if (odds < 0).any():
+            raise ValueError('Odds cannot be negative.')
+        pairs = tuple(zip((v for v, p in self), odds.tolist()))
+        return Distribution._from_pairs(pairs, sum(p for v, p in pairs), force_flatten=self.force_flatten, force_merge=self.force_merge, resolution=self.resolution)
+
+    def bucket(self, width=None, bins=None):
+        """
+        Caps the number of distinct numeric values, which otherwise keeps
+        growing in long numeric pipelines due to floating point noise.
+
+        - `width`: rounds values to the nearest multiple of `width`. The result
+        keeps this resolution, so values derived from it with `map`, `filter`
+        and `join` are rounded too. The error is at most `width/2`.
+        - `bins`: groups values into this many equal-width bins between the
+        smallest and largest values, each represented by the (odds weighted)
+        mean of its values, preserving the expected value.
+        """
+        if width is not None:
+            return Distribution(*self, force_merge=self.force_merge, resolution=width, exact=self.exact)
+        if bins is None:
+            raise ValueError('Either `width` or `bins` must be given.')
+
+        pairs = [(v, p) for v, p in self]
+        if not pairs:
+            return self
+        low = min(v for v, p in pairs)
+        high = max(v for v, p in pairs)
+        size = (high - low) / bins or 1
+        sums = defaultdict(lambda: [0, 0])
+        for v, p in pairs:
+            bin_sums = sums[min(int((v - low) / size), bins - 1)]
+            bin_sums[0] += v * p
+            bin_sums[1] += p
+        return Distribution(*((total / odds if odds else low + (i + 0.5) * size, odds) for i, (total, odds) in sorted(sums.items())), force_merge=self.force_merge, exact=self.exact)
+
+    def scan(self, n, step, init=None, stop=None):
+        """
+        Models `n` independent draws from this distribution while carrying a
+        state, like a dynamic program: each draw replaces the state with
+        `step(state, value)`, and equal states are merged before the next
+        draw. Yields the distribution of states after each draw.
+
+        `init` is the initial state, or a distribution of initial states.
+        States for which `stop(state)` is true are absorbing, and are carried
+        over unchanged. Like in `map`, states are rounded to this
+        distribution's resolution, and distributions returned by `step` are
+        flattened. Example:
+
+            # Distribution of the running total of three dice.
+            list(dice.scan(3, lambda total, roll: total + roll, init=0))
+        """
+        states = init if isinstance(init, Distribution) else Fixed(init)
+        for _ in range(n):
+            counter = Counter()
+            for state, odds in states:
+                if stop is not None and stop(state):
+                    counter[state] += odds * self.total
+                    continue
+                for value, p in self:
+                    new_state = step(state, value)
+                    if self.resolution is not None:
+                        new_state = _snap(new_state, self.resolution)
+                    counter[new_state] += odds * p
+            states = Distribution(*counter.items(), force_flatten=self.force_flatten, resolution=self.resolution, exact=self.exact)
+            yield states
+
+    def fold(self, n, step, init=None, stop=None):
+        """
+        Returns the distribution of the final state after `n` draws. See
+        `scan` for details. Example:
+
+            # Odds of having rolled a 6 in ten tries.
+            dice.fold(10, lambda seen, roll: roll == 6, init=False, stop=bool)
+        """
+        states = init if isinstance(init, Distribution) else Fixed(init)
+        for states in self.scan(n, step, states, stop):
+            pass
+        return states
 
     def utility(self, utility_function=lambda v: v):
         """
@@ -274,6 +836,22 @@ class Distribution:
     def expected_value(self):
         return self.utility()
 
+    def quantile(self, q):
+        """
+        Returns the smallest value whose cumulative probability is at least
+        `q`, e.g. `q=0.5` for the median. Values must be sortable.
+        """
+        if self.total == 0:
+            raise ValueError('Cannot compute quantile of empty distribution: ' + repr(self))
+        target = q * self.total
+        running = 0
+        for value, odds in sorted(self, key=lambda pair: pair[0]):
+            running += odds
+            if running >= target:
+                return value
+        # Compensate for floating point innacuracies.
+        return value
+
     @property
     def mode(self):
         return max(self.pairs, key=second)[0]
@@ -285,7 +863,11 @@ class Distribution:
         return len(self.pairs)
 
     def __hash__(self):
-        return hash(self.pairs)
+        # Cached, so that hashing deeply nested distributions doesn't recurse
+        # through every level each time.
+        if self._hash is None:
+            self._hash = hash(self.pairs)
+        return self._hash
 
     def __eq__(self, other):
         return self.pairs == (other.pairs if isinstance(other, Distribution) else other)
@@ -313,10 +895,15 @@ class Uniform(Distribution):
             (0.333, 'Tails'),
             (0.333, 'Sideways'),
         )
+
+    With `exact=True`, each item gets odds 1 instead.
     """
     def __init__(self, *items, **kwargs):
         if len(items) == 1 and hasattr(items[0], '__iter__'): items = items[0]
-        super().__init__(*((item, 1/len(items)) for item in items), **kwargs)
+        if kwargs.get('exact'):
+            super().__init__(*((item, 1) for item in items), **kwargs)
+        else:
+            super().__init__(*((item, 1/len(items)) for item in items), **kwargs)
 
 class Fixed(Distribution):
     """
@@ -415,8 +1002,77 @@ class Solution(Distribution):
         juice + sugar_water/2 # total volume: (200+600 + (95+5)/2) = 850
         Solution({juice: 1, sugar_water: 1}) # Mix 1-1, total volume: 1.0, 2.5% sugar
     """
+    @classmethod
+    def mix(cls, ingredients):
+        """
+        Mixes many ingredients in a single pass, without creating intermediate
+        solutions. Each ingredient is either a solution, used in full, or a
+        pair `(solution, volume)`. Example:
+
+            Solution.mix([juice, (sugar_water, 50)])
+        """
+        volumes = Counter()
+        total = 0
+        for ingredient in ingredients:
+            ingredient, volume = cls._as_ingredient(ingredient)
+            cls._pour(volumes, ingredient, volume)
+            total += volume
+        return cls._from_pairs(tuple(volumes.items()), total)
+
+    @staticmethod
+    def _as_ingredient(ingredient):
+        if isinstance(ingredient, Distribution):
+            return ingredient, ingredient.total
+        ingredient, volume = ingredient
+        if volume < 0:
+            raise ValueError('Volumes cannot be negative.')
+        return ingredient, volume
+
+    @staticmethod
+    def _pour(volumes, ingredient, volume):
+        """
+        Adds `volume` units of `ingredient` to the `volumes` mapping, the same
+        way the constructor flattens sub-solutions.
+        """
+        if isinstance(ingredient, Distribution):
+            for v, p in ingredient.normalize():
+                volumes[v] += p * volume
+        else:
+            volumes[ingredient] += volume
+
+    @property
+    def pairs(self):
+        # Solutions poured into with `+=` keep a running mapping of volumes,
+        # and only build the tuple of pairs when it's needed.
+        if self._pairs is None:
+            self._pairs = tuple(self._volumes.items())
+        return self._pairs
+
+    @pairs.setter
+    def pairs(self, pairs):
+        self._pairs = pairs
+        self._volumes = None
+
     def __add__(self, other):
-        return Solution((self, self.total), (other, other.total))
+        return Solution.mix((self, other))
+    def __iadd__(self, other):
+        """
+        Pours `other` (a solution, or a pair `(solution, volume)`) into this
+        solution in place. Note this mutates the object, so it shouldn't be
+        used on solutions that are shared or used as dictionary keys.
+        """
+        ingredient, volume = self._as_ingredient(other)
+        if self._volumes is None:
+            volumes = Counter()
+            for v, p in self.pairs:
+                volumes[v] += p
+            self._volumes = volumes
+        self._pour(self._volumes, ingredient, volume)
+        self._pairs = None
+        self.total += volume
+        self._normalized = None
+        self._hash = None
+        return self
     def __mul__(self, n):
         return Solution(*((v, p*n) for v, p in self))
     __rmul__ = __mul__
@@ -424,8 +1080,1016 @@ class Solution(Distribution):
         return self * (1/n)
     __truediv__ = __div__
 
+# Helpers that `Table` applies directly to its columns.
+_column_projections = {first: 0, second: 1, third: 2, last: -1}
+_column_operators = {lt: operator.lt, le: operator.le, eq: operator.eq, ne: operator.ne, gt: operator.gt, ge: operator.ge, sub: operator.sub, difference: lambda a, b: abs(a - b)}
+_column_reductions = {add: operator.add, mul: operator.mul}
+
+class Table(Distribution):
+    """
+    Distribution of tuples stored as one list per tuple element (columns) and
+    a shared list of odds, as created by `join(..., columnar=True)`. Row
+    tuples are only built if the table is iterated.
+
+    `column(i)`, `filter_columns` and `map_columns` work directly on the
+    columns, and so do `map` and `filter` with the built-in helpers `first`,
+    `second`, `third`, `last`, `lt`, `le`, `eq`, `ne`, `gt`, `ge`, `sub`,
+    `difference`, `add` (i.e. `sum`) and `mul`. Other functions receive row
+    tuples, like in a regular `Distribution`.
+    """
+    def __init__(self, columns, odds, force_merge=True, exact=False):
+        self.columns = columns
+        self.odds = odds
+        self.total = sum(odds)
+        self.force_flatten = True
+        self.force_merge = force_merge
+        self.resolution = None
+        self.exact = exact
+        self._normalized = None
+        self._hash = None
+        self._pairs = None
+
+    @classmethod
+    def product(cls, *ds):
+        """
+        Creates the table of all combinations of values from the given
+        distributions, like `join`, without building any tuples. Unlike
+        `join`, repeated values in `force_merge=False` distributions give
+        repeated rows.
+        """
+        sizes = [len(d) for d in ds]
+        columns = []
+        for i, d in enumerate(ds):
+            repeat = reduce(operator.mul, sizes[i+1:], 1)
+            tile = reduce(operator.mul, sizes[:i], 1)
+            columns.append([v for v, p in d for _ in range(repeat)] * tile)
+        odds = [1]
+        for d in ds:
+            odds = [o * p for o in odds for v, p in d]
+        return cls(columns, odds, force_merge=all(d.force_merge for d in ds), exact=all(d.exact for d in ds))
+
+    @property
+    def pairs(self):
+        if self._pairs is None:
+            self._pairs = tuple(zip(zip(*self.columns), self.odds))
+        return self._pairs
+
+    def __len__(self):
+        return len(self.odds)
+
+    def normalize(self):
+        if self.total == 0 or (self.total == 1 if self.exact else math.isclose(self.total, 1)):
+            return self
+        if self._normalized is None:
+            odds = [Fraction(p, self.total) for p in self.odds] if self.exact else [p/self.total for p in self.odds]
+            self._normalized = Table(self.columns, odds, force_merge=self.force_merge, exact=self.exact)
+        return self._normalized
+
+    def _group(self, values):
+        """
+        Returns the distribution of `values` (one per row), merging equal
+        values unless `force_merge` is false.
+        """
+        if not self.force_merge:
+            return Distribution._from_pairs(tuple(zip(values, self.odds)), self.total, force_merge=False, exact=self.exact)
+        counter = Counter()
+        for value, odds in zip(values, self.odds):
+            counter[value] += odds
+        return Distribution._from_pairs(tuple(counter.items()), self.total, exact=self.exact)
+
+    def column(self, i):
+        """
+        Returns the distribution of the `i`-th element of the rows. Same as
+        `self.map(lambda row: row[i])`.
+        """
+        return self._group(self.columns[i])
+
+    def map_columns(self, fn, *indexes):
+        """
+        Returns the distribution of `fn` applied to the given columns (all, if
+        none given) of each row, as `fn(*elements)`.
+        """
+        columns = [self.columns[i] for i in indexes] if indexes else self.columns
+        return self._group(map(fn, *columns))
+
+    def filter_columns(self, fn, *indexes):
+        """
+        Like `filter`, but `fn` is called with the given columns (all, if none
+        given) of each row, as `fn(*elements)`. Returns another table.
+        """
+        columns = [self.columns[i] for i in indexes] if indexes else self.columns
+        multipliers = map(_exact, map(fn, *columns)) if self.exact else map(fn, *columns)
+        return Table(self.columns, [p * r for p, r in zip(self.odds, multipliers)], force_merge=self.force_merge, exact=self.exact)
+
+    def map(self, fn=None, resolution=None, **kwargs):
+        if not kwargs and resolution is None and callable(fn):
+            if fn in _column_projections:
+                return self.column(_column_projections[fn])
+            elif fn in _column_operators and len(self.columns) == 2:
+                return self.map_columns(_column_operators[fn])
+            elif fn in _column_reductions and self.columns:
+                return self._group(reduce(lambda a, b: list(map(_column_reductions[fn], a, b)), self.columns))
+        return super().map(fn, resolution, **kwargs)
+    group = group_by = map
+
+    def filter(self, fn=None, **kwargs):
+        if not kwargs and callable(fn) and fn in _column_operators and len(self.columns) == 2:
+            return self.filter_columns(_column_operators[fn])
+        return super().filter(fn, **kwargs)
+    update = filter
+
+class Belief:
+    """
+    Mutable companion of `Distribution` for online updating, where creating
+    new distributions for every observation would be wasteful. The odds are
+    kept in a list that is updated in place. Example:
+
+        belief = Belief(coins)
+        for toss in tosses:
+            belief.update(lambda c: c[toss]).renormalize()
+        belief.freeze().plot()
+    """
+    def __init__(self, d=()):
+        """
+        Creates a belief from a distribution, or any iterable of pairs
+        `(value, odds)`. Frozen beliefs keep the flags of the original
+        distribution, e.g. beliefs created from exact distributions keep
+        exact odds.
+        """
+        pairs = d.pairs if isinstance(d, Distribution) else tuple(d)
+        self.exact = getattr(d, 'exact', False)
+        self.force_flatten = getattr(d, 'force_flatten', True)
+        self.force_merge = getattr(d, 'force_merge', True)
+        self.resolution = getattr(d, 'resolution', None)
+        self.values = [v for v, p in pairs]
+        self.odds = [p for v, p in pairs]
+        self.total = sum(self.odds)
+        self._index = None
+        # Converting back is free until the first modification.
+        self._frozen = d if isinstance(d, Distribution) else None
+
+    def _modified(self):
+        self._frozen = None
+        return self
+
+    def update(self, fn=None, **kwargs):
+        """
+        Multiplies the odds of each value by `fn(value)`, in place. `fn`
+        follows the same conventions as `Distribution.filter`.
+        """
+        fn = Distribution._prepare_transformation(fn, kwargs)
+        odds = self.odds
+        for i, value in enumerate(self.values):
+            odds[i] *= _exact(fn(value)) if self.exact else fn(value)
+        self.total = sum(odds)
+        return self._modified()
+    filter = update
+
+    def renormalize(self):
+        """
+        Scales the odds in place, so that they sum to 1.
+        """
+        if self.total and self.total != 1:
+            odds = self.odds
+            for i, p in enumerate(odds):
+                odds[i] = Fraction(p) / self.total if self.exact else p / self.total
+            self.total = sum(odds)
+            self._modified()
+        return self
+
+    def add(self, value, odds):
+        """
+        Adds `odds` to the odds of `value`, which is appended if new.
+        """
+        if odds < 0:
+            raise ValueError('Odds cannot be negative.')
+        if self.exact:
+            odds = _exact(odds)
+        if self._index is None:
+            self._index = {v: i for i, v in enumerate(self.values)}
+        i = self._index.get(value)
+        if i is None:
+            self._index[value] = len(self.values)
+            self.values.append(value)
+            self.odds.append(odds)
+        else:
+            self.odds[i] += odds
+        self.total += odds
+        return self._modified()
+
+    def freeze(self):
+        """
+        Returns the current state as an immutable `Distribution`. The result
+        is reused until the belief is modified again.
+        """
+        if self._frozen is None:
+            self._frozen = Distribution._from_pairs(tuple(zip(self.values, self.odds)), self.total, force_flatten=self.force_flatten, force_merge=self.force_merge, resolution=self.resolution, exact=self.exact)
+        return self._frozen
+    to_distribution = freeze
+
+    def __getitem__(self, target):
+        if self._index is None:
+            self._index = {v: i for i, v in enumerate(self.values)}
+        return self.odds[self._index[target]]
+
+    def __iter__(self):
+        return zip(self.values, self.odds)
+
+    def __len__(self):
+        return len(self.values)
+
+class Joint:
+    """
+    Joint distribution of independent components that are kept as separate
+    factors, and only multiplied together when an operation couples them.
+    Components are referenced by position, or by name if given as keyword
+    arguments. Example:
+
+        j = Joint(toss=coin, roll=dice, other=d20)
+        j = j.filter(lambda roll: roll > 4, on='roll')
+        j.marginal('toss') # Never enumerates the d20.
+        j.filter(lambda e: e[0] == 'Heads' or e[1] == 6, on=('toss', 'roll')) # Multiplies only toss and roll.
+    """
+    def __init__(self, *ds, **named):
+        self.keys = list(range(len(ds))) + list(named)
+        self.factors = [((key, ), d.map(lambda v: (v, ))) for key, d in itertools.chain(enumerate(ds), named.items())]
+
+    @classmethod
+    def _from_factors(cls, keys, factors):
+        self = object.__new__(cls)
+        self.keys = keys
+        self.factors = factors
+        return self
+
+    @staticmethod
+    def _product(a, b):
+        """
+        Multiplies two factors `(keys, distribution)` into a single one.
+        """
+        (keys_a, d_a), (keys_b, d_b) = a, b
+        pairs = tuple((v_a + v_b, p_a * p_b) for v_a, p_a in d_a for v_b, p_b in d_b)
+        # Values are unique combinations of unique values, no need to merge.
+        d = Distribution._from_pairs(pairs, sum(p for v, p in pairs), force_merge=d_a.force_merge and d_b.force_merge, exact=d_a.exact and d_b.exact)
+        return keys_a + keys_b, d
+
+    def _couple(self, on):
+        """
+        Returns the list of factors where all factors containing keys from
+        `on` have been multiplied into one, and the index of that factor.
+        """
+        for key in on:
+            if key not in self.keys:
+                raise KeyError(key)
+        selected = [f for f in self.factors if any(key in f[0] for key in on)]
+        others = [f for f in self.factors if not any(key in f[0] for key in on)]
+        return others + [reduce(self._product, selected)]
+
+    def _selector(self, keys, on):
+        """
+        Returns a function that extracts the values of `on` from a tuple of
+        values for `keys`. A single key gives a single value, a tuple of keys
+        gives a tuple of values.
+        """
+        if isinstance(on, tuple):
+            positions = [keys.index(key) for key in on]
+            return lambda v: tuple(v[i] for i in positions)
+        position = keys.index(on)
+        return lambda v: v[position]
+
+    def _normalize_on(self, on):
+        if on is None:
+            return tuple(self.keys)
+        return on
+
+    def filter(self, fn=None, on=None, **kwargs):
+        """
+        Like `Distribution.filter`, but `fn` is invoked only with the value
+        of the component `on` (or the tuple of values, if `on` is a tuple of
+        components). Only the factors containing these components are
+        touched. If `on` is not given, all components are used.
+        """
+        fn = Distribution._prepare_transformation(fn, kwargs)
+        on = self._normalize_on(on)
+        *others, (keys, d) = self._couple(on if isinstance(on, tuple) else (on, ))
+        select = self._selector(keys, on)
+        return Joint._from_factors(self.keys, others + [(keys, d.filter(lambda v: fn(select(v))))])
+    update = filter
+
+    def map(self, fn=None, on=None, into=None, **kwargs):
+        """
+        Like `Distribution.map`, but `fn` is invoked only with the value of
+        the component `on` (or the tuple of values, if `on` is a tuple of
+        components). The components used are replaced by a single new
+        component named `into`, which defaults to `on` itself (or its first
+        element, if it's a tuple).
+        """
+        fn = Distribution._prepare_transformation(fn, kwargs)
+        on = self._normalize_on(on)
+        on_keys = on if isinstance(on, tuple) else (on, )
+        if into is None:
+            into = on_keys[0]
+        if into in self.keys and into not in on_keys:
+            raise ValueError('Component already exists: ' + repr(into))
+
+        *others, (keys, d) = self._couple(on_keys)
+        select = self._selector(keys, on)
+        kept = [i for i, key in enumerate(keys) if key not in on_keys]
+        new_keys = tuple(keys[i] for i in kept) + (into, )
+        new_d = d.map(lambda v: tuple(v[i] for i in kept) + (fn(select(v)), ))
+
+        first_index = min(self.keys.index(key) for key in on_keys)
+        all_keys = [key for i, key in enumerate(self.keys) if key not in on_keys or i == first_index]
+        all_keys[all_keys.index(self.keys[first_index])] = into
+        return Joint._from_factors(all_keys, others + [(new_keys, new_d)])
+
+    def marginal(self, *on):
+        """
+        Returns the distribution of the given components, as single values if
+        only one component is given, or as tuples otherwise. Only the factors
+        containing these components are multiplied, the others contribute only
+        their total odds.
+        """
+        if not on:
+            on = tuple(self.keys)
+        *others, (keys, d) = self._couple(on)
+        select = self._selector(keys, on if len(on) > 1 else on[0])
+        result = d.map(select)
+        other_total = reduce(operator.mul, (f_d.total for f_keys, f_d in others), 1)
+        if other_total == 1:
+            return result
+        pairs = tuple((v, p*other_total) for v, p in result)
+        return Distribution._from_pairs(pairs, sum(p for v, p in pairs), force_merge=result.force_merge, exact=result.exact)
+
+    def flatten(self):
+        """
+        Multiplies all factors into a single flat distribution of tuples, in
+        the order of the components. Equivalent to `join` of the components.
+        """
+        return self.marginal(*self.keys) if len(self.keys) != 1 else self.marginal(*self.keys).map(lambda v: (v, ))
+
+
+class Pipeline:
+    """
+    A `join` followed by `filter` and `map` steps over some input
+    distributions, which can be compiled once and then re-evaluated for
+    different input odds without running the value logic again. Useful for
+    sensitivity analysis. Example:
+
+        biased = lambda p: Distribution(Heads=p, Tails=1-p)
+        unbias = Pipeline(biased(0.5), biased(0.5)).filter(not_equals).map(first).compile()
+        unbias(biased(0.7), biased(0.7))
+        unbias.batch([(biased(p), biased(p)) for p in (0.1, 0.2, 0.3)])
+
+    With a single input the steps receive its values directly, otherwise they
+    receive tuples, like the values of `join`.
+
+    `generate` and `estimate` sample from the pipeline directly, which
+    works even when the joined distribution is too large to enumerate:
+
+        doors = Pipeline(Count(1000), Count(1000)).filter(not_equals).map(first)
+        doors.estimate(10000)
+    """
+    def __init__(self, *inputs):
+        self.inputs = inputs
+        self.steps = ()
+
+    def _then(self, kind, fn):
+        pipeline = Pipeline(*self.inputs)
+        pipeline.steps = self.steps + ((kind, fn), )
+        return pipeline
+
+    def filter(self, fn=None, **kwargs):
+        """
+        Adds a step like `Distribution.filter`.
+        """
+        return self._then('filter', Distribution._prepare_transformation(fn, kwargs))
+    update = filter
+
+    def starfilter(self, fn):
+        """
+        Adds a step like `Distribution.starfilter`.
+        """
+        return self.filter(lambda e: fn(*e))
+
+    def map(self, fn=None, **kwargs):
+        """
+        Adds a step like `Distribution.map`. `fn` may also return
+        distributions, which are flattened.
+        """
+        return self._then('map', Distribution._prepare_transformation(fn, kwargs))
+
+    def starmap(self, fn):
+        """
+        Adds a step like `Distribution.starmap`.
+        """
+        return self.map(lambda e: fn(*e))
+
+    def _apply(self, value):
+        """
+        Runs the steps on a single combination of input values, returning the
+        list of pairs `(output value, odds multiplier)`.
+        """
+        items = [(value, 1)]
+        for kind, fn in self.steps:
+            if kind == 'filter':
+                items = [(v, m * fn(v)) for v, m in items]
+            else:
+                mapped = []
+                for v, m in items:
+                    result = fn(v)
+                    if isinstance(result, Distribution):
+                        mapped.extend((leaf, m * odds) for leaf, odds in result._leaves())
+                    else:
+                        mapped.append((result, m))
+                items = mapped
+        return items
+
+    def _combinations(self):
+        """
+        Generates the index of each input value in every combination, and the
+        value passed to the first step.
+        """
+        supports = [[v for v, p in d] for d in self.inputs]
+        for indexes in itertools.product(*(range(len(support)) for support in supports)):
+            values = tuple(support[i] for support, i in zip(supports, indexes))
+            yield indexes, (values[0] if len(supports) == 1 else values)
+
+    def _sample(self, reject):
+        """
+        Draws each input independently and runs the steps on the combined
+        value, sampling from any distributions returned by maps. Returns the
+        pair `(output value, weight)`, or None if the sample was rejected
+        (including by a map returning an empty distribution). If
+        `reject` is true filters are applied by rejection, keeping the sample
+        with probability equal to the filter's result, and the weight is
+        always 1. Otherwise the results of filters are multiplied into the
+        weight (likelihood weighting).
+        """
+        values = tuple(random.choices(support, cum_weights=cum_weights)[0] for support, cum_weights in self._cummulative)
+        value = values[0] if len(values) == 1 else values
+        weight = 1
+        for kind, fn in self.steps:
+            if kind == 'filter':
+                multiplier = fn(value)
+                if reject:
+                    if not 0 <= multiplier <= 1:
+                        raise ValueError('Rejection sampling requires filter results between 0 and 1, got ' + repr(multiplier))
+                    if multiplier < 1 and random.random() >= multiplier:
+                        return None
+                else:
+                    weight *= multiplier
+                    if not weight:
+                        return None
+            else:
+                value = fn(value)
+                if isinstance(value, Distribution):
+                    if not value.total:
+                        # Empty distributions exclude the case, like in `map`.
+                        return None
+                    value = next(value.generate(1))
+        return value, weight
+
+    def _prepare_sampling(self):
+        for d in self.inputs:
+            if d.total == 0:
+                raise ValueError('Cannot sample from empty distribution: ' + repr(d))
+        self._cummulative = [([v for v, p in d], list(itertools.accumulate(p for v, p in d))) for d in self.inputs]
+
+    def generate(self, n=-1, max_rejections=100000):
+        """
+        Generates random examples of the pipeline's output without building
+        the joined distribution, drawing each input independently and
+        discarding draws rejected by the filters. Filters must return values
+        between 0 and 1. If `n` is given, only `n` examples are generated.
+
+        Raises ValueError after `max_rejections` consecutive rejected draws,
+        which happens when the filters reject (almost) every draw.
+        """
+        self._prepare_sampling()
+        rejections = 0
+        while n != 0:
+            sample = self._sample(reject=True)
+            if sample is None:
+                rejections += 1
+                if rejections >= max_rejections:
+                    raise ValueError('Rejected {} draws in a row, the filters may exclude every value.'.format(rejections))
+                continue
+            rejections = 0
+            yield sample[0]
+            n -= 1
+
+    def estimate(self, n=100000):
+        """
+        Approximates `evaluate` from `n` random draws of the inputs, without
+        building the joined distribution. Filters weight the draws instead of
+        rejecting them, so they may return any non-negative odds.
+        """
+        self._prepare_sampling()
+        counter = Counter()
+        for i in range(n):
+            sample = self._sample(reject=False)
+            if sample is not None:
+                counter[sample[0]] += sample[1]
+        return Distribution(*counter.items())
+
+    def evaluate(self):
+        """
+        Runs the pipeline on the inputs, returning the resulting distribution.
+        """
+        # The odds are already aligned with the supports, even if the inputs
+        # have repeated values.
+        odds = [[p for v, p in d] for d in self.inputs]
+        return self.compile()._results([odds], [bool(self.inputs) and all(d.exact for d in self.inputs)])[0]
+
+    def compile(self):
+        """
+        Runs the value logic once for every combination of input values,
+        returning a `CompiledPipeline` that only recomputes odds.
+        """
+        outputs = {}
+        rows = []
+        for indexes, value in self._combinations():
+            for output, multiplier in self._apply(value):
+                target = outputs.setdefault(output, len(outputs))
+                if multiplier:
+                    rows.append((indexes, target, multiplier))
+        return CompiledPipeline([[v for v, p in d] for d in self.inputs], list(outputs), rows)
+
+class CompiledPipeline:
+    """
+    A `Pipeline` reduced to a list of rows `(input indexes, output index,
+    multiplier)`: each output's odds are the sum over its rows of the
+    multiplier times the odds of the referenced input values. Evaluating it
+    for new input odds is a sparse multilinear product, vectorized with NumPy
+    if available, and never calls the value logic of the pipeline.
+    """
+    def __init__(self, supports, outputs, rows):
+        self.supports = supports
+        self.outputs = outputs
+        self.rows = rows
+        if numpy is not None and rows:
+            self._indexes = numpy.array([indexes for indexes, target, multiplier in rows], dtype=numpy.intp).T
+            self._targets = numpy.array([target for indexes, target, multiplier in rows], dtype=numpy.intp)
+            self._multipliers = numpy.array([multiplier for indexes, target, multiplier in rows], dtype=float)
+
+    def _odds(self, i, d):
+        """
+        Returns the odds of input `i` aligned with the support it was compiled
+        with. `d` is either a distribution with (a subset of) the same values,
+        or a sequence of odds in the original order. Values that were not in
+        the compiled support, or that are repeated, raise ValueError.
+        """
+        if isinstance(d, Distribution):
+            odds = {}
+            for v, p in d:
+                if v in odds:
+                    raise ValueError('Repeated value for input {}: {!r}'.format(i, v))
+                odds[v] = p
+            unknown = odds.keys() - set(self.supports[i])
+            if unknown:
+                raise ValueError('Values not in the compiled support of input {}: {!r}'.format(i, sorted(unknown, key=repr)))
+            return [odds.get(v, 0) for v in self.supports[i]]
+        if len(d) != len(self.supports[i]):
+            raise ValueError('Expected {} odds for input {}, got {}.'.format(len(self.supports[i]), i, len(d)))
+        return list(d)
+
+    def __call__(self, *inputs):
+        """
+        Returns the output distribution for the given inputs (distributions
+        or sequences of odds, see `_odds`).
+        """
+        return self.batch([inputs])[0]
+
+    def batch(self, inputs_list):
+        """
+        Returns the output distributions for many sets of inputs at once.
+        Sets of inputs that are all exact distributions give exact results,
+        computed without NumPy.
+        """
+        odds = [[self._odds(i, d) for i, d in enumerate(inputs)] for inputs in inputs_list]
+        exact = [bool(inputs) and all(getattr(d, 'exact', False) for d in inputs) for inputs in inputs_list]
+        return self._results(odds, exact)
+
+    def _results(self, odds, exact):
+        """
+        Returns the output distributions for a list of odds vectors (one per
+        input, aligned with the supports), and whether each is exact.
+        """
+        inexact = [vectors for vectors, is_exact in zip(odds, exact) if not is_exact]
+        if numpy is not None and self.rows and inexact:
+            inexact_totals = iter(self._batch_numpy(inexact))
+        else:
+            inexact_totals = (self._evaluate(vectors) for vectors in inexact)
+
+        results = []
+        for vectors, is_exact in zip(odds, exact):
+            if is_exact:
+                results.append(Distribution(*zip(self.outputs, self._evaluate(vectors, exact=True)), exact=True))
+            else:
+                row = next(inexact_totals)
+                results.append(Distribution._from_pairs(tuple(zip(self.outputs, row)), sum(row)))
+        return results
+
+    def _evaluate(self, vectors, exact=False):
+        totals = [0] * len(self.outputs)
+        for indexes, target, multiplier in self.rows:
+            if exact:
+                multiplier = _exact(multiplier)
+            for vector, i in zip(vectors, indexes):
+                multiplier *= vector[i]
+            totals[target] += multiplier
+        return totals
+
+    def _batch_numpy(self, odds):
+        # One row of odds per element of the batch, for each input.
+        matrices = [numpy.array([vectors[i] for vectors in odds], dtype=float) for i in range(len(self.supports))]
+        products = numpy.tile(self._multipliers, (len(odds), 1))
+        for matrix, indexes in zip(matrices, self._indexes):
+            products *= matrix[:, indexes]
+        totals = numpy.zeros((len(odds), len(self.outputs)))
+        for row, product in zip(totals, products):
+            row += numpy.bincount(self._targets, weights=product, minlength=len(self.outputs))
+        return totals.tolist()
+
+def fingerprint(d):
+    """
+    Returns a stable hex digest of the content of a distribution (its values,
+    odds and flags), suitable for identifying it across processes. Values
+    must have a deterministic `repr`, as builtin types do.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((type(d).__name__, d.force_merge, d.force_flatten, d.resolution, d.exact)).encode())
+    for value, odds in d:
+        encoded = fingerprint(value) if isinstance(value, Distribution) else repr(value)
+        digest.update(encoded.encode() + b'\0' + repr(odds).encode() + b'\0')
+    return digest.hexdigest()
+
+def _code_identity(code):
+    constants = tuple(_code_identity(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts)
+    return (code.co_code, constants, code.co_names)
+
+def _captured_identity(value, seen):
+    if isinstance(value, Distribution):
+        return fingerprint(value)
+    elif getattr(value, '__code__', None) is not None:
+        return _function_identity(value, seen)
+    else:
+        return repr(value)
+
+def _function_identity(fn, seen=frozenset()):
+    """
+    Identifies a function by its name, bytecode, default arguments and the
+    values captured by its closure, so that editing the function or
+    creating it with different captured values gives a different identity.
+    Globals are not considered, use the `version` argument of `Cache` for
+    those.
+    """
+    code = getattr(fn, '__code__', None)
+    if code is not None:
+        if id(fn) in seen:
+            # Recursive closure.
+            return (fn.__module__, fn.__qualname__)
+        seen = seen | {id(fn)}
+        captured = []
+        for cell in getattr(fn, '__closure__', None) or ():
+            try:
+                captured.append(_captured_identity(cell.cell_contents, seen))
+            except ValueError:
+                # Empty cell.
+                captured.append(None)
+        defaults = tuple(_captured_identity(v, seen) for v in getattr(fn, '__defaults__', None) or ())
+        kwdefaults = tuple((k, _captured_identity(v, seen)) for k, v in sorted((getattr(fn, '__kwdefaults__', None) or {}).items()))
+        bound = _captured_identity(fn.__self__, seen) if hasattr(fn, '__self__') else None
+        return (fn.__module__, fn.__qualname__, _code_identity(code), tuple(captured), defaults, kwdefaults, bound)
+    elif callable(fn):
+        return (getattr(fn, '__module__', None), getattr(fn, '__qualname__', repr(fn)))
+    else:
+        # Dictionaries, lists, and other arguments to `map` and `filter`.
+        return repr(fn)
+
+class Cache:
+    """
+    Opt-in on-disk cache of expensive operations, keyed by the content of the
+    input distributions, the operation, and the identity of the function
+    used. Entries are written atomically, so the same directory can be
+    shared between local processes, and the least recently used entries are
+    evicted when the total size goes over `max_size` bytes. Example:
+
+        cache = Cache('~/.cache/monty')
+        hands = cache.call(lambda d: d.deal(5), deck)
+        ranks = cache.map(deck, first)
+    """
+    def __init__(self, directory, max_size=2**30):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, operation, fn, *ds, version=None):
+        """
+        Returns the key identifying the result of `operation` with function
+        `fn` applied to the distributions `ds`.
+        """
+        digest = hashlib.sha256()
+        for part in (operation, _function_identity(fn), version) + tuple(fingerprint(d) for d in ds):
+            digest.update(repr(part).encode() + b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the result stored under `key`, or stores and returns the
+        result of `compute()` if there's none.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            # Mark as recently used.
+            os.utime(path)
+            return result
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+
+        result = compute()
+        # Write to a temporary file and rename, so other processes never see
+        # partially written entries.
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+            try:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except BaseException:
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+        self._evict()
+        return result
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the total size is under
+        `max_size`. Entries removed concurrently by other processes are
+        ignored.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for mtime, entry_size, path in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def call(self, fn, *ds, version=None):
+        """
+        Returns `fn(*ds)`, cached. `version` can be changed to invalidate
+        results when `fn` depends on something other than its own code.
+        """
+        return self.get_or_compute(self.key('call', fn, *ds, version=version), lambda: fn(*ds))
+
+    def join(self, *ds):
+        """
+        Cached version of `join(*ds)`.
+        """
+        return self.get_or_compute(self.key('join', None, *ds), lambda: join(*ds))
+
+    def map(self, d, fn=None, version=None, **kwargs):
+        """
+        Cached version of `d.map(fn, **kwargs)`.
+        """
+        return self.get_or_compute(self.key('map', fn or kwargs, d, version=version), lambda: d.map(fn, **kwargs))
+
+    def filter(self, d, fn=None, version=None, **kwargs):
+        """
+        Cached version of `d.filter(fn, **kwargs)`.
+        """
+        return self.get_or_compute(self.key('filter', fn or kwargs, d, version=version), lambda: d.filter(fn, **kwargs))
+
+    def invalidate(self, key):
+        """
+        Removes the entry stored under `key`, if any.
+        """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                self.invalidate(entry.name[:-len('.pickle')])
+
+
+class Server:
+    """
+    Holds named distributions in memory and answers queries about them, so
+    that clients don't pay for startup and rebuilding base distributions.
+    Requests are JSON objects with an "op" field:
+
+        {"op": "names"}
+        {"op": "join", "sources": ["dice", "coin"], "name": "game"}
+        {"op": "map", "source": "deck", "fn": "first", "name": "ranks"}
+        {"op": "filter", "source": "dice", "fn": "bool", "name": "nonzero"}
+        {"op": "expected_value", "source": "dice"}
+        {"op": "quantiles", "source": "dice", "q": [0.25, 0.5, 0.75]}
+        {"op": "sample", "source": "deck", "n": 5}
+
+    `map`, `filter` and `join` store their result under "name", if given.
+    Functions are referenced by the names they were registered with. Start it
+    with `python -m monty serve`, or see `serve`.
+    """
+    read_only = {'names', 'expected_value', 'quantiles', 'sample'}
+    # Random results must be computed separately for every request.
+    nondeterministic = {'sample'}
+    # Largest number of examples returned by a single "sample" request.
+    max_sample = 100000
+
+    def __init__(self, distributions=None, functions=None):
+        if distributions is None:
+            distributions = {name: value for name, value in globals().items() if isinstance(value, Distribution) and not name.startswith('_')}
+        if functions is None:
+            functions = dict(lt=lt, le=le, eq=eq, ne=ne, gt=gt, ge=ge, contains=contains, add=add, sub=sub, difference=difference, mul=mul, first=first, second=second, third=third, last=last, sum=sum, len=len, str=str, bool=bool, abs=abs, min=min, max=max)
+        self.distributions = dict(distributions)
+        self.functions = dict(functions)
+        self.requests = queue.Queue()
+
+    def register(self, name, d):
+        """
+        Makes the distribution `d` available to queries as `name`.
+        """
+        self.distributions[name] = d
+
+    def register_function(self, name, fn):
+        """
+        Makes the function `fn` available to `map` and `filter` queries as
+        `name`.
+        """
+        self.functions[name] = fn
+
+    def handle(self, request):
+        """
+        Answers a single request, returning the response object.
+        """
+        if not isinstance(request, dict):
+            return {'error': 'Invalid request: expected an object, got {}'.format(type(request).__name__)}
+        try:
+            response = {'result': self._execute(request)}
+        except Exception as e:
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def handle_batch(self, requests):
+        """
+        Answers many requests in order. Identical read-only requests are
+        computed only once, as long as no distribution was modified in
+        between, except for random ones like "sample".
+        """
+        responses = []
+        answered = {}
+        for request in requests:
+            op = request.get('op') if isinstance(request, dict) else None
+            if op in self.nondeterministic:
+                responses.append(self.handle(request))
+                continue
+            if op not in self.read_only:
+                answered.clear()
+                responses.append(self.handle(request))
+                continue
+            key = json.dumps({k: v for k, v in request.items() if k != 'id'}, sort_keys=True)
+            if key not in answered:
+                answered[key] = self.handle(dict(request, id=None))
+            response = dict(answered[key])
+            response.pop('id')
+            if 'id' in request:
+                response['id'] = request['id']
+            responses.append(response)
+        return responses
+
+    def _execute(self, request):
+        op = request['op']
+        if op == 'names':
+            return sorted(self.distributions)
+        elif op == 'join':
+            return self._store(request, join(*(self.distributions[name] for name in request['sources'])))
+
+        d = self.distributions[request['source']]
+        if op == 'map':
+            return self._store(request, d.map(self.functions[request['fn']]))
+        elif op == 'filter':
+            return self._store(request, d.filter(self.functions[request['fn']]))
+        elif op == 'expected_value':
+            return d.expected_value
+        elif op == 'quantiles':
+            return [d.quantile(q) for q in request['q']]
+        elif op == 'sample':
+            n = request.get('n', 1)
+            if not isinstance(n, int) or isinstance(n, bool) or not 0 <= n <= self.max_sample:
+                raise ValueError('"n" must be an integer between 0 and {}, got {!r}'.format(self.max_sample, n))
+            return list(d.generate(n))
+        else:
+            raise ValueError('Unknown operation: ' + repr(op))
+
+    def _store(self, request, d):
+        if 'name' in request:
+            self.distributions[request['name']] = d
+        return {'size': len(d)}
+
+    def process(self):
+        """
+        Answers requests submitted by connections, forever. Every request
+        waiting in the queue is answered in a single batch.
+        """
+        while True:
+            batch = [self.requests.get()]
+            while True:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            responses = self.handle_batch([request for request, reply in batch])
+            for (request, reply), response in zip(batch, responses):
+                reply.put(response)
+
+    def submit(self, request):
+        """
+        Queues a request to be answered by `process`, and waits for the
+        response.
+        """
+        reply = queue.Queue(maxsize=1)
+        self.requests.put((request, reply))
+        return reply.get()
+
+def serve(server=None, port=None, socket_path=None):
+    """
+    Answers requests to `server` sent as JSON lines over a Unix socket at
+    `socket_path`, or over localhost TCP at `port` (default 7879). Each
+    connection may send any number of requests, one per line, and receives
+    one response per line.
+    """
+    server = server or Server()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    response = server.submit(json.loads(line))
+                except ValueError as e:
+                    response = {'error': 'Invalid request: {}'.format(e)}
+                self.wfile.write(json.dumps(response, default=str).encode() + b'\n')
+
+    if socket_path is not None:
+        listener = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    else:
+        listener = socketserver.ThreadingTCPServer(('localhost', port or 7879), Handler)
+    listener.daemon_threads = True
+    threading.Thread(target=server.process, daemon=True).start()
+    with listener:
+        listener.serve_forever()
+
+def _serve_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m monty serve', description='Serves queries about distributions held in memory.')
+    parser.add_argument('--port', type=int, help='localhost TCP port to listen on (default 7879)')
+    parser.add_argument('--socket', help='path of Unix socket to listen on, instead of TCP')
+    parser.add_argument('--load', action='append', default=[], metavar='MODULE', help='import MODULE and register its public distributions and functions')
+    options = parser.parse_args(args)
+
+    server = Server()
+    for module_name in options.load:
+        module = importlib.import_module(module_name)
+        for name, value in vars(module).items():
+            if name.startswith('_'):
+                continue
+            if isinstance(value, Distribution):
+                server.register(name, value)
+            elif isinstance(value, types.FunctionType):
+                server.register_function(name, value)
+    serve(server, port=options.port, socket_path=options.socket)
 
 if __name__ == '__main__':
+    import sys
+    if sys.argv[1:2] == ['serve']:
+        # Import by name so that loaded modules share our Distribution class.
+        import monty
+        sys.exit(monty._serve_main(sys.argv[2:]))
+
     # Breast cancer
     # -------------
     # Taken from https://betterexplained.com/articles/an-intuitive-and-short-explanation-of-bayes-theorem/ :
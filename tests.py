@@ -1,7 +1,12 @@
 import io
+import os
+import tempfile
+import threading
 from contextlib import redirect_stdout
 from replace_me import hardcode_me
 import unittest
+from fractions import Fraction
+import monty
 from monty import *
 
 class TestConstruction(unittest.TestCase):
@@ -44,6 +49,24 @@ class TestConstruction(unittest.TestCase):
         d = Distribution([('a', 40), (Distribution(b=5, c=5), 20)], force_flatten=False)
         self.assertEqual(list(d), [('a', 40), (Distribution(b=5, c=5), 20)])
 
+    def test_deep_sub_distribution(self):
+        d = Fixed('leaf')
+        for i in range(5000):
+            d = Distribution((d, 1), (i, 1), force_flatten=False)
+        inner = d.pairs[0][0]
+        d = Distribution((d, 1))
+        self.assertEqual(list(d), [(inner, 0.5), (4999, 0.5)])
+
+    def test_nested_not_flatten(self):
+        coins = Distribution((coin, 1), (Fixed('Heads'), 1), force_flatten=False)
+        d = Distribution((coins, 1), ('x', 1))
+        self.assertEqual(list(d), [(coin, 0.5), (Fixed('Heads'), 0.5), ('x', 1)])
+
+    def test_shared_sub_distribution(self):
+        shared = Distribution(b=1, c=3)
+        d = Distribution((Distribution((shared, 1), ('a', 1)), 2), (shared, 2))
+        self.assertEqual(list(d), [('b', 0.75), ('c', 2.25), ('a', 1.0)])
+
     def test_merge(self):
         d = Distribution(('a', 10), ('b', 5), ('a', 5))
         self.assertEqual(list(d), [('a', 15), ('b', 5)])
@@ -101,6 +124,15 @@ class TestNormalize(unittest.TestCase):
         d = Distribution(('a', 1), ('a', 4), force_merge=False)
         self.assertEqual(list(d.normalize()), [('a', 0.2), ('a', 0.8)])
 
+    def test_cached(self):
+        d = Distribution(A=7, B=3)
+        self.assertIs(d.normalize(), d.normalize())
+
+    def test_keeps_flags(self):
+        d = Distribution(('a', 1), ('a', 4), force_merge=False, force_flatten=False).normalize()
+        self.assertEqual((d.force_merge, d.force_flatten), (False, False))
+        self.assertEqual(d.total, 1)
+
 class TestGenerate(unittest.TestCase):
     def test_empty(self):
         with self.assertRaises(ValueError):
@@ -129,6 +161,51 @@ class TestGenerate(unittest.TestCase):
             return ['A', 'B', 'C', 'A']
         Distribution(A=1, B=2).monte_carlo(process, n=100)
 
+class TestWithoutReplacement(unittest.TestCase):
+    def test_ordered(self):
+        d = Distribution(A=2, B=1, C=1).sample_without_replacement(2)
+        self.assertEqual(d[('A', 'B')], 0.25)
+        self.assertAlmostEqual(d[('B', 'A')], 1/6)
+        self.assertEqual(len(d), 6)
+
+    def test_deal(self):
+        d = Distribution(A=2, B=1, C=1).deal(2)
+        self.assertEqual([v for v, p in d], [('A', 'B'), ('A', 'C'), ('B', 'C')])
+        self.assertAlmostEqual(d[('B', 'C')], 1/6)
+
+    def test_deal_uniform(self):
+        self.assertEqual(Uniform('abc').deal(2), ((('a', 'b'), 1/3), (('a', 'c'), 1/3), (('b', 'c'), 1/3)))
+
+    def test_deal_empty(self):
+        self.assertEqual(Distribution(a=0, b=0).deal(1).total, 0)
+
+    def test_too_many(self):
+        with self.assertRaises(ValueError):
+            coin.deal(3)
+
+    def test_hypergeometric(self):
+        d = deck.hypergeometric(5, lambda card: card[1] == 'Hearts')
+        self.assertEqual([v for v, p in d], [0, 1, 2, 3, 4, 5])
+        self.assertAlmostEqual(d[2], 13*12/2 * 39*38*37/6 / (52*51*50*49*48/120))
+
+    def test_hypergeometric_weighted(self):
+        d = Distribution(A=2, B=1, C=1).hypergeometric(2, ['A'])
+        self.assertAlmostEqual(d[1], 5/6)
+
+    def test_generate(self):
+        draws = list(Distribution(A=2, B=1, C=0).generate_without_replacement(2, 10))
+        self.assertEqual(len(draws), 10)
+        self.assertTrue(all(sorted(draw) == ['A', 'B'] for draw in draws))
+
+    def test_generate_tiny_odds(self):
+        d = Distribution(*((i, 1e-9) for i in range(100)))
+        first_values = [draw[0] for draw in d.generate_without_replacement(1, 200)]
+        self.assertGreater(len(set(first_values)), 10)
+
+    def test_generate_too_many(self):
+        with self.assertRaises(ValueError):
+            list(Distribution(A=2, B=0).generate_without_replacement(2, 1))
+
 class TestPlot(unittest.TestCase):
     def test_empty(self):
         self.assertEqual(Distribution().as_plot(), '\n')
@@ -157,6 +234,20 @@ class TestPlot(unittest.TestCase):
     def test_non_hashable(self):
         self.assertEqual(Distribution((list(), 1), force_merge=False).as_plot(), '\n                           [] 100.00% [========================================]\n')
 
+    def test_top(self):
+        self.assertEqual(Distribution(A=1, B=2, C=1).as_plot(top=1), '\n                            B  50.00% [====================                    ]\n                        Other  50.00% [====================                    ]\n')
+
+    def test_top_not_sort(self):
+        self.assertEqual(Distribution(A=1, B=1, C=2).as_plot(top=2, sort=False), '\n                            A  25.00% [==========                              ]\n                            C  50.00% [====================                    ]\n                        Other  25.00% [==========                              ]\n')
+
+    def test_bins(self):
+        self.assertEqual(Count(4).as_plot(bins=2), '\n                     [1, 2.5)  50.00% [====================                    ]\n                     [2.5, 4]  50.00% [====================                    ]\n')
+
+    def test_plot_file(self):
+        f = io.StringIO()
+        Distribution(A=1, B=2).plot(file=f)
+        self.assertEqual(f.getvalue(), Distribution(A=1, B=2).as_plot() + '\n')
+
 class TestJoin(unittest.TestCase):
     def test_one_empty(self):
         self.assertEqual(list(join(Distribution())), [])
@@ -183,6 +274,123 @@ class TestJoin(unittest.TestCase):
     def test_multiplication(self):
         self.assertEqual(list(2*Distribution(A=5, B=10)), [(('A', 'A'), 25), (('A', 'B'), 50), (('B', 'A'), 50), (('B', 'B'), 100)])
 
+class TestUnorderedPower(unittest.TestCase):
+    def test_multinomial(self):
+        self.assertEqual(Distribution(A=1, B=3).unordered_power(2), ((('A', 'A'), 1), (('A', 'B'), 6), (('B', 'B'), 9)))
+
+    def test_size(self):
+        self.assertEqual(len(dice.unordered_power(10)), 3003)
+
+    def test_same_as_ordered(self):
+        either = lambda pair: 2 in pair or 5 in pair
+        self.assertAlmostEqual(dice.combinations(2).map(either)[True], (2*dice).map(either)[True])
+
+    def test_zero(self):
+        self.assertEqual(coin.unordered_power(0), (((), 1),))
+
+class TestFold(unittest.TestCase):
+    def test_running_total(self):
+        d = dice.fold(3, lambda total, roll: total + roll, init=0)
+        expected = (3*dice).map(sum)
+        self.assertEqual(len(d), len(expected))
+        for value, odds in expected:
+            self.assertAlmostEqual(d[value], odds)
+
+    def test_zero_steps(self):
+        self.assertEqual(dice.fold(0, lambda total, roll: total + roll, init=0), ((0, 1),))
+
+    def test_stop(self):
+        d = dice.fold(10, lambda seen, roll: roll == 6, init=False, stop=bool)
+        self.assertAlmostEqual(d[True], 1 - (5/6)**10)
+
+    def test_scan(self):
+        self.assertEqual([len(d) for d in dice.scan(3, lambda total, roll: total + roll, init=0)], [6, 11, 16])
+
+    def test_initial_distribution(self):
+        self.assertEqual(coin.fold(1, lambda a, b: a + b, init=Uniform('x', 'y')), (('xHeads', 0.25), ('xTails', 0.25), ('yHeads', 0.25), ('yTails', 0.25)))
+
+    def test_resolution(self):
+        d = Distribution((0.1, 1), (0.2, 1), resolution=0.1).fold(3, lambda s, v: s + v, init=0)
+        self.assertEqual([v for v, p in d], [0.3, 0.4, 0.5, 0.6])
+        self.assertEqual(d.resolution, 0.1)
+
+    def test_flatten(self):
+        self.assertEqual(Fixed(1).fold(1, lambda s, v: Uniform(s, s + v), init=0), ((0, 0.5), (1, 0.5)))
+
+class TestCompare(unittest.TestCase):
+    def setUp(self):
+        self.a = Uniform(2, 2, 4, 4, 9, 9)
+        self.b = Uniform(1, 1, 6, 6, 8, 8)
+
+    def test_compare(self):
+        d = self.a.compare(self.b)
+        self.assertAlmostEqual(d[1], join(self.a, self.b).map(gt)[True])
+        self.assertAlmostEqual(d[-1], join(self.a, self.b).map(lt)[True])
+        self.assertEqual(d[0], 0)
+
+    def test_compare_ties(self):
+        self.assertAlmostEqual(dice.compare(dice)[0], 1/6)
+
+    def test_beats(self):
+        self.assertAlmostEqual(self.a.beats(self.b), 5/9)
+
+    def test_maximum(self):
+        self.assertEqual(dict(self.a.maximum(self.b)), {2: 1/9, 4: 1/9, 6: 2/9, 8: 2/9, 9: 3/9})
+
+    def test_minimum(self):
+        expected = join(dice, d4).map(min)
+        d = dice.minimum(d4)
+        self.assertEqual([v for v, p in d], [1, 2, 3, 4])
+        for value, odds in expected:
+            self.assertAlmostEqual(d[value], odds)
+
+class TestTable(unittest.TestCase):
+    def setUp(self):
+        self.table = join(dice, d4, columnar=True)
+        self.rows = join(dice, d4)
+
+    def test_rows(self):
+        self.assertIsInstance(self.table, Table)
+        self.assertEqual(len(self.table), 24)
+        self.assertEqual(self.table, self.rows)
+
+    def test_repeated_values(self):
+        a = Distribution((1, 1), (1, 1), force_merge=False)
+        self.assertEqual(join(a, coin, columnar=True), join(a, coin))
+        self.assertEqual(len(join(a, coin, columnar=True)), 2)
+        table = Table.product(a, coin)
+        self.assertEqual(table.map(first), Distribution(*table, force_merge=False).map(first))
+        self.assertEqual(table.column(0), ((1, 0.5), (1, 0.5), (1, 0.5), (1, 0.5)))
+
+    def test_columns(self):
+        self.assertEqual(self.table.columns[1][:5], [1, 2, 3, 4, 1])
+        self.assertEqual(self.table.column(1), self.rows.map(second))
+
+    def test_map_helpers(self):
+        for fn in (first, second, last, gt, eq, sub, difference, sum, mul):
+            self.assertEqual(self.table.map(fn), self.rows.map(fn))
+
+    def test_map_other(self):
+        self.assertEqual(self.table.map({row: row[0] for row, odds in self.rows}), self.rows.map(first))
+        self.assertEqual(self.table.map(lambda row: row[0] % 2), self.rows.map(lambda row: row[0] % 2))
+
+    def test_filter_helpers(self):
+        filtered = self.table.filter(ne)
+        self.assertIsInstance(filtered, Table)
+        self.assertEqual(filtered, self.rows.filter(ne))
+        self.assertEqual(filtered.map(second), self.rows.filter(ne).map(second))
+
+    def test_filter_columns(self):
+        self.assertEqual(self.table.filter_columns(lambda v: v > 2, 1), self.rows.filter(lambda row: row[1] > 2))
+
+    def test_map_columns(self):
+        self.assertEqual(self.table.map_columns(lambda a, b: a * 10 + b), self.rows.starmap(lambda a, b: a * 10 + b))
+
+    def test_normalize(self):
+        table = join(Distribution(A=1, B=3), coin, columnar=True).normalize()
+        self.assertIsInstance(table, Table)
+        self.assertEqual(table.column(0), (('A', 0.25), ('B', 0.75)))
+
 class TestStatistics(unittest.TestCase):
     def test_expected_value(self):
         self.assertEqual(Distribution((1, 0.5), (2, 0.5)).expected_value, 1.5)
@@ -193,6 +401,13 @@ class TestStatistics(unittest.TestCase):
     def test_expected_value_empty(self):
         self.assertEqual(Distribution().expected_value, 0)
 
+    def test_quantile(self):
+        self.assertEqual([dice.quantile(q) for q in (0, 0.5, 0.51, 1)], [1, 3, 4, 6])
+
+    def test_quantile_empty(self):
+        with self.assertRaises(ValueError):
+            Distribution().quantile(0.5)
+
     def test_mode(self):
         self.assertEqual(Distribution(A=5, B=10, C=5).mode, 'B')
 
@@ -235,6 +450,74 @@ class TestMap(unittest.TestCase):
         d = Distribution((0, 0.5), (3, 0.5), force_merge=False)
         self.assertEqual(d.map(lambda i: [1]*i), (([], 0.5), ([1, 1, 1], 0.5)))
 
+class TestBucket(unittest.TestCase):
+    def test_width(self):
+        d = Distribution((0.1, 1), (0.12, 1), (0.31, 2)).bucket(0.25)
+        self.assertEqual(d, ((0.0, 2), (0.25, 2)))
+
+    def test_no_arguments(self):
+        with self.assertRaises(ValueError):
+            Count(4).bucket()
+
+    def test_propagates(self):
+        d = Distribution((1.0, 1), (1.0000001, 1)).bucket(0.5)
+        self.assertEqual(d.map(lambda v: v * 3).resolution, 0.5)
+        self.assertEqual(d.map(lambda v: v * 3.0000001), ((3.0, 2),))
+        self.assertEqual(join(d, d).map(sum), ((2.0, 4),))
+
+    def test_tuples(self):
+        self.assertEqual(Distribution(((0.9, 'a'), 1), ((1.1, 'a'), 1), resolution=1), (((1, 'a'), 2),))
+
+    def test_map_resolution(self):
+        self.assertEqual(Count(4).map(lambda v: v / 4, resolution=1), ((0, 0.5), (1, 0.5)))
+
+    def test_bins(self):
+        d = Count(4).bucket(bins=2)
+        self.assertEqual(d, ((1.5, 0.5), (3.5, 0.5)))
+        self.assertEqual(d.expected_value, Count(4).expected_value)
+
+class TestArray(unittest.TestCase):
+    def test_map_fallback(self):
+        self.assertEqual(coin.map_array(str.lower), (('heads', 0.5), ('tails', 0.5)))
+
+    def test_filter_fallback(self):
+        self.assertEqual(join(Count(2), Count(2)).filter_array(lambda a, b: a != b), join(Count(2), Count(2)).filter(ne))
+
+    def test_without_numpy(self):
+        numpy, monty.numpy = monty.numpy, None
+        try:
+            self.assertEqual(join(Count(2), Count(2)).map_array(lambda a, b: a + b), join(Count(2), Count(2)).map(sum))
+        finally:
+            monty.numpy = numpy
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_map(self):
+        self.assertEqual(Range(20).map_array(lambda x: x % 7), Range(20).map(lambda x: x % 7))
+        self.assertEqual(join(dice, dice).map_array(lambda a, b: a > b), join(dice, dice).map(gt))
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_map_tuples(self):
+        self.assertEqual(Count(2).map_array(lambda x: (x, x * 2)), (((1, 2), 0.5), ((2, 4), 0.5)))
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_map_scalar(self):
+        self.assertEqual(Count(4).map_array(lambda x: 1), ((1, 1.0),))
+        self.assertEqual(Count(2).map_array(lambda x: (x, 0)), (((1, 0), 0.5), ((2, 0), 0.5)))
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_map_without_merge(self):
+        d = Count(4, force_merge=False).map_array(lambda x: x % 2)
+        self.assertEqual(list(d), [(1, 0.25), (0, 0.25), (1, 0.25), (0, 0.25)])
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_filter(self):
+        self.assertEqual(Count(4).filter_array(lambda x: x % 2 == 0), ((1, 0), (2, 0.25), (3, 0), (4, 0.25)))
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_filter_negative(self):
+        with self.assertRaises(ValueError):
+            dice.filter_array(lambda x: x - 3)
+
 class TestFilter(unittest.TestCase):
     def test_empty(self):
         self.assertEqual(Distribution().filter(lambda e: e), ())
@@ -261,6 +544,53 @@ class TestFilter(unittest.TestCase):
         d = Distribution(([], 0.5), ([1, 2, 3], 0.5), force_merge=False)
         self.assertEqual(d.filter(len), (([], 0.0), ([1, 2, 3], 1.5)))
 
+class TestBelief(unittest.TestCase):
+    def test_round_trip(self):
+        d = Distribution(A=1, B=3)
+        self.assertIs(Belief(d).freeze(), d)
+        self.assertEqual(Belief([('A', 1), ('B', 3)]).freeze(), d)
+
+    def test_update(self):
+        belief = Belief(Distribution(A=1, B=3))
+        odds = belief.odds
+        belief.update(A=2, B=1)
+        self.assertIs(belief.odds, odds)
+        self.assertEqual(belief.freeze(), Distribution(A=1, B=3).filter(A=2, B=1))
+
+    def test_renormalize(self):
+        belief = Belief(Distribution(A=1, B=3)).renormalize()
+        self.assertEqual(list(belief), [('A', 0.25), ('B', 0.75)])
+        self.assertEqual(belief.total, 1)
+
+    def test_same_as_filter(self):
+        coins = Uniform(*[Distribution(Heads=i/4, Tails=REST) for i in range(5)], force_flatten=False)
+        belief = Belief(coins)
+        for toss in ['Heads', 'Heads', 'Tails']:
+            belief.update(lambda c: c[toss]).renormalize()
+            coins = coins.filter(lambda c: c[toss]).normalize()
+        for (value, odds), (expected_value, expected_odds) in zip(belief.freeze(), coins):
+            self.assertEqual(value, expected_value)
+            self.assertAlmostEqual(odds, expected_odds)
+
+    def test_freeze_keeps_flags(self):
+        coins = Uniform(*[Distribution(Heads=i/4, Tails=REST) for i in range(5)], force_flatten=False)
+        frozen = Belief(coins).update(lambda c: c['Heads']).freeze()
+        self.assertFalse(frozen.force_flatten)
+        self.assertEqual(len(frozen.filter(lambda c: c['Heads'])), 5)
+        frozen = Belief(Distribution(('a', 1), ('a', 1), force_merge=False)).update(a=2).freeze()
+        self.assertFalse(frozen.force_merge)
+
+    def test_add(self):
+        belief = Belief(Distribution(A=1))
+        belief.add('A', 2).add('B', 1)
+        self.assertEqual(belief.freeze(), (('A', 3), ('B', 1)))
+        self.assertEqual(belief['B'], 1)
+        self.assertEqual(belief.total, 4)
+
+    def test_add_negative(self):
+        with self.assertRaises(ValueError):
+            Belief().add('A', -1)
+
 class TestHelpers(unittest.TestCase):
     def test_uniform_empty(self):
         self.assertEqual(Uniform(), ())
@@ -286,6 +616,34 @@ class TestHelpers(unittest.TestCase):
     def test_count_explicit(self):
         self.assertEqual(Count(3, 4), ((3, 0.5), (4, 0.5)))
 
+class TestJoint(unittest.TestCase):
+    def test_flatten(self):
+        self.assertEqual(Joint(coin, dice).flatten(), join(coin, dice))
+
+    def test_factors_kept_separate(self):
+        j = Joint(toss=coin, roll=dice, other=d20).filter(lambda r: r > 4, on='roll')
+        self.assertEqual(len(j.factors), 3)
+        self.assertAlmostEqual(j.marginal('roll')[6], 1/6)
+        self.assertEqual(j.marginal('roll')[1], 0)
+
+    def test_coupled_filter(self):
+        j = Joint(toss=coin, roll=dice, other=d20).filter(lambda s: s[0] == 'Heads' and s[1] > 4, on=('toss', 'roll'))
+        self.assertEqual(len(j.factors), 2)
+        self.assertAlmostEqual(j.marginal('toss')['Heads'], 1/6)
+
+    def test_map_into(self):
+        j = Joint(dice, dice, coin).map(sum, on=(0, 1), into='total')
+        self.assertEqual(j.keys, ['total', 2])
+        self.assertEqual(j.marginal('total'), (2*dice).map(sum))
+
+    def test_marginal_keeps_other_totals(self):
+        j = Joint(Distribution(A=1, B=3), Distribution(C=2))
+        self.assertEqual(j.marginal(0), (('A', 2), ('B', 6)))
+
+    def test_missing_component(self):
+        with self.assertRaises(KeyError):
+            Joint(coin).marginal('missing')
+
 class TestSolution(unittest.TestCase):
     def setUp(self):
         self.orange = Solution(Orange=1)
@@ -307,5 +665,283 @@ class TestSolution(unittest.TestCase):
     def test_div(self):
         self.assertEqual(self.juice/2, (('Water', 150), ('Orange', 350)))
 
+    def test_mix(self):
+        mix = Solution.mix([self.juice, (self.water, 100), (self.juice, 500)])
+        self.assertIsInstance(mix, Solution)
+        self.assertEqual(mix, (('Water', 550), ('Orange', 1050)))
+        self.assertEqual(mix.total, 1600)
+
+    def test_mix_empty(self):
+        self.assertEqual(Solution.mix([]), ())
+
+    def test_mix_negative(self):
+        with self.assertRaises(ValueError):
+            Solution.mix([(self.juice, -1)])
+
+    def test_iadd(self):
+        mix = Solution(Water=1)
+        mix.normalize()
+        mix += self.juice
+        mix += (self.orange, 100)
+        self.assertEqual(mix, (('Water', 301), ('Orange', 800)))
+        self.assertEqual(mix.total, 1101)
+        self.assertEqual(mix.normalize()['Orange'], 800/1101)
+
+    def test_iadd_duplicates(self):
+        mix = Solution(('a', 1), ('a', 2), force_merge=False)
+        mix += Solution(b=1)
+        self.assertEqual(mix, (('a', 3), ('b', 1)))
+        self.assertEqual(mix.total, 4)
+
+class TestPipeline(unittest.TestCase):
+    def biased(self, p):
+        return Distribution(Heads=p, Tails=1-p)
+
+    def test_evaluate(self):
+        pipeline = Pipeline(self.biased(0.6), self.biased(0.6)).filter(not_equals).map(first)
+        self.assertEqual(pipeline.evaluate(), (2*self.biased(0.6)).filter(not_equals).map(first))
+
+    def test_recompute_without_value_logic(self):
+        calls = []
+        def log(v):
+            calls.append(v)
+            return v
+        compiled = Pipeline(Count(3)).map(log).filter(lambda v: v > 1).compile()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(compiled(Distribution((1, 5), (2, 1), (3, 2))), ((1, 0), (2, 1), (3, 2)))
+        self.assertEqual(len(calls), 3)
+
+    def test_odds_sequences(self):
+        compiled = Pipeline(Count(2), Count(2)).starmap(lambda a, b: a * b).compile()
+        self.assertEqual(compiled([1, 3], [1, 1]), ((1, 1), (2, 4), (4, 3)))
+
+    def test_batch(self):
+        compiled = Pipeline(self.biased(0.5), self.biased(0.5)).filter(not_equals).map(first).compile()
+        results = compiled.batch([(self.biased(p), self.biased(p)) for p in (0.1, 0.7)])
+        self.assertEqual([d.normalize()['Heads'] for d in results], [0.5, 0.5])
+        self.assertAlmostEqual(results[0].total, 2 * 0.1 * 0.9)
+
+    def test_map_distribution(self):
+        self.assertEqual(Pipeline(Count(2)).map(lambda v: Uniform(v, 0)).evaluate(), ((1, 0.25), (0, 0.5), (2, 0.25)))
+
+    def test_wrong_length(self):
+        with self.assertRaises(ValueError):
+            Pipeline(coin).compile()([1, 2, 3])
+
+    def test_repeated_input_values(self):
+        d = Distribution(('a', 1), ('a', 1), force_merge=False)
+        self.assertEqual(Pipeline(d).evaluate(), (('a', 2),))
+
+    def test_unknown_values(self):
+        compiled = Pipeline(Count(3)).map(lambda v: v % 2).compile()
+        self.assertEqual(compiled(Count(2)), ((1, 0.5), (0, 0.5)))
+        with self.assertRaises(ValueError):
+            compiled(Count(4))
+        with self.assertRaises(ValueError):
+            compiled(Distribution((1, 1), (1, 1), force_merge=False))
+
+    def test_without_numpy(self):
+        numpy, monty.numpy = monty.numpy, None
+        try:
+            compiled = Pipeline(Count(2), Count(2)).starmap(lambda a, b: a * b).compile()
+            self.assertEqual(compiled([1, 3], [1, 1]), ((1, 1), (2, 4), (4, 3)))
+        finally:
+            monty.numpy = numpy
+
+    def test_generate(self):
+        pipeline = Pipeline(Count(3), Count(3)).filter(not_equals).map(first)
+        self.assertEqual(len(list(pipeline.generate(20))), 20)
+        self.assertTrue(all(v in (1, 2, 3) for v in pipeline.generate(20)))
+        self.assertEqual(set(Pipeline(Count(1000), Count(1000)).filter(lambda e: e[0] == 1).map(first).generate(5)), {1})
+        self.assertEqual(list(Pipeline(Count(2)).generate(0)), [])
+
+    def test_sample_empty_map(self):
+        pipeline = Pipeline(Count(2)).map(lambda v: Uniform() if v == 1 else v)
+        self.assertEqual(list(pipeline.generate(5)), [2] * 5)
+        self.assertEqual([v for v, p in pipeline.estimate(100)], [2])
+
+    def test_generate_invalid_filter(self):
+        with self.assertRaises(ValueError):
+            list(Pipeline(Count(2)).filter(lambda v: 2).generate(1))
+        with self.assertRaises(ValueError):
+            list(Pipeline(Distribution()).generate(1))
+        with self.assertRaises(ValueError):
+            list(Pipeline(coin).filter(lambda c: 0).generate(1, max_rejections=100))
+
+    def test_estimate(self):
+        d = Pipeline(Count(3), Count(3)).filter(lambda e: e[0] < e[1]).map(lambda e: Uniform(e)).estimate(1000)
+        self.assertAlmostEqual(d.total, 1000 / 3, delta=100)
+        self.assertTrue({v for v, p in d} <= {1, 2, 3})
+        d = Pipeline(Count(2)).filter(lambda v: 4 if v == 1 else 0).estimate(100)
+        self.assertEqual([v for v, p in d], [1])
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = Cache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint(Uniform(1, 2)), fingerprint(Uniform(1, 2)))
+        self.assertNotEqual(fingerprint(Uniform(1, 2)), fingerprint(Uniform(1, 3)))
+        self.assertNotEqual(fingerprint(Distribution((1.0, 1))), fingerprint(Distribution((1.0, 1), resolution=0.5)))
+        self.assertNotEqual(fingerprint(Distribution(x=1, y=1)), fingerprint(Distribution(x=1, y=1, exact=True)))
+
+    def test_hit(self):
+        self.calls = []
+        def double(v):
+            self.calls.append(v)
+            return v * 2
+        self.assertEqual(self.cache.map(Count(2), double), ((2, 0.5), (4, 0.5)))
+        self.assertEqual(self.cache.map(Count(2), double), ((2, 0.5), (4, 0.5)))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_closures(self):
+        coins = Distribution({('Heads', 'Tails'): 0.5, ('Heads', 'Heads'): 0.5})
+        results = [self.cache.filter(coins, lambda c: c[toss] == 'Heads') for toss in (0, 1)]
+        self.assertEqual(results, [coins.filter(lambda c: c[0] == 'Heads'), coins.filter(lambda c: c[1] == 'Heads')])
+        def times(n):
+            return lambda v: v * n
+        self.assertNotEqual(self.cache.key('map', times(2), coin), self.cache.key('map', times(3), coin))
+        self.assertEqual(self.cache.key('map', times(2), coin), self.cache.key('map', times(2), coin))
+        self.assertNotEqual(self.cache.key('map', lambda v, n=2: v * n, coin), self.cache.key('map', lambda v, n=3: v * n, coin))
+
+    def test_persistent(self):
+        self.cache.join(coin, coin)
+        self.assertEqual(Cache(self.directory.name).get_or_compute(self.cache.key('join', None, coin, coin), lambda: None), join(coin, coin))
+
+    def test_version(self):
+        self.assertNotEqual(self.cache.key('map', len, coin, version=1), self.cache.key('map', len, coin, version=2))
+
+    def test_invalidate(self):
+        self.cache.call(lambda d: d.deal(2), coin)
+        self.cache.invalidate(self.cache.key('call', lambda d: d.deal(2), coin))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_evict(self):
+        cache = Cache(self.directory.name, max_size=0)
+        cache.map(coin, str.lower)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+
+    def test_map_and_query(self):
+        self.assertEqual(self.server.handle({'op': 'map', 'source': 'deck', 'fn': 'second', 'name': 'suits'}), {'result': {'size': 4}})
+        self.assertEqual(self.server.handle({'op': 'quantiles', 'source': 'suits', 'q': [0, 1]}), {'result': ['Clubs', 'Spades']})
+
+    def test_expected_value(self):
+        self.assertEqual(self.server.handle({'op': 'expected_value', 'source': 'dice', 'id': 1}), {'result': 3.5, 'id': 1})
+
+    def test_registered_function(self):
+        self.server.register('d', Count(4))
+        self.server.register_function('even', lambda v: v % 2 == 0)
+        self.server.handle({'op': 'filter', 'source': 'd', 'fn': 'even', 'name': 'd'})
+        self.assertEqual(self.server.handle({'op': 'expected_value', 'source': 'd'}), {'result': 3})
+
+    def test_error(self):
+        self.assertIn('error', self.server.handle({'op': 'expected_value', 'source': 'missing'}))
+
+    def test_invalid_request(self):
+        responses = self.server.handle_batch([[1, 2], 'names', {'op': 'expected_value', 'source': 'dice'}])
+        self.assertIn('error', responses[0])
+        self.assertIn('error', responses[1])
+        self.assertEqual(responses[2], {'result': 3.5})
+
+    def test_process_survives_invalid_request(self):
+        threading.Thread(target=self.server.process, daemon=True).start()
+        self.assertIn('error', self.server.submit([1, 2]))
+        self.assertEqual(self.server.submit({'op': 'expected_value', 'source': 'dice'}), {'result': 3.5})
+
+    def test_invalid_sample_size(self):
+        for n in (-1, 0.5, True, '3', Server.max_sample + 1):
+            self.assertIn('error', self.server.handle({'op': 'sample', 'source': 'coin', 'n': n}))
+        self.assertEqual(self.server.handle({'op': 'sample', 'source': 'coin', 'n': 0}), {'result': []})
+
+    def test_batch_sample(self):
+        calls = []
+        execute = self.server._execute
+        self.server._execute = lambda request: calls.append(request) or execute(request)
+        responses = self.server.handle_batch([{'op': 'sample', 'source': 'deck', 'n': 3}] * 2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([len(response['result']) for response in responses], [3, 3])
+
+    def test_batch(self):
+        calls = []
+        self.server.register_function('log', lambda v: calls.append(v) or v)
+        responses = self.server.handle_batch([
+            {'op': 'expected_value', 'source': 'dice', 'id': 1},
+            {'op': 'expected_value', 'source': 'dice', 'id': 2},
+            {'op': 'map', 'source': 'dice', 'fn': 'log', 'name': 'dice'},
+            {'op': 'expected_value', 'source': 'dice'},
+        ])
+        self.assertEqual(responses, [{'result': 3.5, 'id': 1}, {'result': 3.5, 'id': 2}, {'result': {'size': 6}}, {'result': 3.5}])
+        self.assertEqual(len(calls), 6)
+
+class TestExact(unittest.TestCase):
+    def test_uniform(self):
+        self.assertEqual(list(Uniform('ab', exact=True)), [('a', 1), ('b', 1)])
+        self.assertEqual(list(Range(3, exact=True)), [(0, 1), (1, 1), (2, 1)])
+        self.assertEqual(Count(6, exact=True).total, 6)
+
+    def test_normalize(self):
+        d = Count(3, exact=True).normalize()
+        self.assertEqual(list(d), [(1, Fraction(1, 3)), (2, Fraction(1, 3)), (3, Fraction(1, 3))])
+        self.assertEqual(d.total, 1)
+        self.assertIs(d.normalize(), d)
+
+    def test_join(self):
+        d = join(Count(6, exact=True), Count(6, exact=True)).map(sum)
+        self.assertTrue(d.exact)
+        self.assertEqual(d[7], 6)
+        self.assertEqual(d.normalize()[7], Fraction(1, 6))
+        self.assertEqual(d.expected_value, 7)
+        self.assertFalse(join(Count(6, exact=True), Count(6)).exact)
+
+    def test_scaling(self):
+        self.assertEqual(list(Distribution(A=0.1, B=0.3, exact=True)), [('A', 1), ('B', 3)])
+        d = Distribution({Uniform(1, 2, 3, exact=True): Fraction(1, 2), 'x': REST}, exact=True)
+        self.assertEqual(list(d), [(1, 1), (2, 1), (3, 1), ('x', 3)])
+
+    def test_permutations(self):
+        self.assertEqual(list(Permutations('Goat', 'Goat', 'Car', exact=True)), [(('Goat', 'Goat', 'Car'), 2), (('Goat', 'Car', 'Goat'), 2), (('Car', 'Goat', 'Goat'), 2)])
+
+    def test_filter(self):
+        self.assertEqual(list(Count(2, exact=True).filter(lambda v: 0.5 if v == 1 else 1)), [(1, 1), (2, 2)])
+
+    def test_plot(self):
+        self.assertIn('50.00%', Uniform('ab', exact=True).as_plot())
+
+    def test_compare(self):
+        d = Count(6, exact=True)
+        self.assertEqual(d.compare(d), ((-1, 15), (0, 6), (1, 15)))
+        self.assertEqual(d.maximum(d).normalize()[6], Fraction(11, 36))
+        self.assertEqual(d.minimum(d).normalize()[6], Fraction(1, 36))
+
+    def test_hypergeometric(self):
+        d = Count(10, exact=True).hypergeometric(3, lambda v: v < 4)
+        self.assertTrue(d.exact)
+        self.assertEqual(d.normalize()[1], Fraction(21, 40))
+
+    def test_belief(self):
+        belief = Belief(Count(2, exact=True))
+        belief.update(lambda v: 0.5 if v == 1 else 1).renormalize()
+        self.assertEqual(belief.freeze(), ((1, Fraction(1, 3)), (2, Fraction(2, 3))))
+        self.assertTrue(belief.freeze().exact)
+
+    def test_compiled_pipeline(self):
+        compiled = Pipeline(Count(6)).filter(lambda v: 0.5 if v > 3 else 1).map(lambda v: v % 2).compile()
+        self.assertEqual(compiled(Count(6, exact=True)), ((1, 5), (0, 4)))
+
+    @unittest.skipIf(monty.numpy is None, 'NumPy not installed')
+    def test_array(self):
+        d = Count(6, exact=True)
+        self.assertEqual(d.map_array(lambda x: x % 2), ((1, 3), (0, 3)))
+        self.assertTrue(d.filter_array(lambda x: x > 4).exact)
+        self.assertEqual(d.filter_array(lambda x: x > 4).normalize()[5], Fraction(1, 2))
+
 if __name__  == '__main__':
     unittest.main()